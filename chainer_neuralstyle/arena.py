@@ -0,0 +1,251 @@
+"""NumPy engine with a preallocated activation arena for repeated same-shape inference.
+
+The first call at an input shape plans every buffer of the forward pass;
+later calls at that shape only run GEMMs into those buffers and in-place
+elementwise ops, so they make no large allocations:
+
+- each convolution input is a zero-bordered buffer whose interior the
+  previous layer writes into, so padding is never rebuilt;
+- the residual blocks share one trunk buffer, the skip connection is added
+  into it in place;
+- the deconvolution accumulators ping-pong between two buffers;
+- the GEMM outputs, im2col bands, ELU temporaries and deconvolution columns
+  are views into shared scratch buffers, since each is dead once the next
+  layer has consumed it.
+
+The result (and the arrays passed to `hook`) are owned by the arena and are
+overwritten by the next call; copy them to keep them.
+"""
+from __future__ import print_function
+import time
+import argparse
+
+import numpy as np
+
+from numpy_engine import NumpyStyleNet, load_params, im2col, IM2COL_BYTES
+
+def conv_size(size, k, stride, pad):
+    return (size + 2 * pad - k) // stride + 1
+
+def deconv_size(size, k, stride, pad):
+    return (size - 1) * stride + k - 2 * pad
+
+def interior(buf, pad):
+    return buf[:, pad:buf.shape[1] - pad, pad:buf.shape[2] - pad]
+
+def elu_(x, tmp):
+    """In-place ELU, `tmp` is scratch of x's shape."""
+    np.minimum(x, 0, out=tmp)
+    np.expm1(tmp, out=tmp)
+    np.maximum(x, 0, out=x)
+    x += tmp
+    return x
+
+def batch_norm_(x, scale, shift, out):
+    np.multiply(x, scale, out=out)
+    out += shift
+    return out
+
+class ArenaStyleNet(NumpyStyleNet):
+    """NumpyStyleNet (float32) that reuses one set of buffers per input shape."""
+
+    def __init__(self, params):
+        super(ArenaStyleNet, self).__init__(params, np.float32, subpixel=False)
+        # GEMM operands: (k*k*c_i, c_o) for convolutions, (c_i, k*k*c_o) for deconvolutions
+        self.gemm_W = {}
+        for name, W in self.params.items():
+            if name.endswith('_W'):
+                layer = name[:-len('_W')]
+                W2 = W.reshape(W.shape[0], -1)
+                self.gemm_W[layer] = np.ascontiguousarray(W2 if layer.startswith('d') else W2.T)
+        self.shape = None
+
+    def kernel(self, layer):
+        return self.params[layer + '_W'].shape[1]
+
+    def plan(self, shape):
+        """Allocates the buffers for inputs of `shape` (n, h, w, 3)."""
+        n, h, w = shape[:3]
+        c = dict((layer, self.params[layer + '_b'].shape[0]) for layer in ('c1', 'c2', 'c3', 'd1', 'd2', 'd3'))
+        sizes = {'gemm_out': 0, 'cols': 0, 'gemm_in': 0, 'tmp': 0}
+        self.bands = {}
+        self.buffers = buffers = {}
+
+        def conv(layer, c_i, c_o, h, w, stride, pad):
+            k = self.kernel(layer)
+            h_o, w_o = conv_size(h, k, stride, pad), conv_size(w, k, stride, pad)
+            self.bands[layer] = band = max(1, IM2COL_BYTES // (w_o * k * k * c_i * 4))
+            sizes['cols'] = max(sizes['cols'], min(band, h_o) * w_o * k * k * c_i)
+            sizes['gemm_out'] = max(sizes['gemm_out'], n * h_o * w_o * c_o)
+            sizes['tmp'] = max(sizes['tmp'], n * h_o * w_o * c_o)
+            return h_o, w_o
+
+        def deconv(layer, c_i, c_o, h, w, stride, pad):
+            k = self.kernel(layer)
+            self.bands[layer] = band = max(1, IM2COL_BYTES // (w * k * k * c_o * 4))
+            sizes['cols'] = max(sizes['cols'], min(band, h) * w * k * k * c_o)
+            sizes['gemm_in'] = max(sizes['gemm_in'], min(band, h) * w * c_i)
+            full = ((h - 1) * stride + k, (w - 1) * stride + k)
+            h_o, w_o = deconv_size(h, k, stride, pad), deconv_size(w, k, stride, pad)
+            sizes['tmp'] = max(sizes['tmp'], n * h_o * w_o * c_o)
+            return full, (h_o, w_o)
+
+        buffers['c1_in'] = np.zeros((n, h + 8, w + 8, 3), np.float32)
+        h1, w1 = conv('c1', 3, c['c1'], h, w, 1, 4)
+        buffers['c2_in'] = np.zeros((n, h1 + 2, w1 + 2, c['c1']), np.float32)
+        h2, w2 = conv('c2', c['c1'], c['c2'], h1, w1, 2, 1)
+        buffers['c3_in'] = np.zeros((n, h2 + 2, w2 + 2, c['c2']), np.float32)
+        h3, w3 = conv('c3', c['c2'], c['c3'], h2, w2, 2, 1)
+        buffers['trunk'] = np.zeros((n, h3 + 2, w3 + 2, c['c3']), np.float32)
+        buffers['residual'] = np.zeros((n, h3 + 2, w3 + 2, c['c3']), np.float32)
+        for i in range(1, self.n_residual + 1):
+            conv('r{}_c1'.format(i), c['c3'], c['c3'], h3, w3, 1, 1)
+            conv('r{}_c2'.format(i), c['c3'], c['c3'], h3, w3, 1, 1)
+        full1, (h4, w4) = deconv('d1', c['c3'], c['d1'], h3, w3, 2, 1)
+        full2, (h5, w5) = deconv('d2', c['d1'], c['d2'], h4, w4, 2, 1)
+        full3, (h6, w6) = deconv('d3', c['d2'], c['d3'], h5, w5, 1, 4)
+        accumulator = max(full1[0] * full1[1] * c['d1'], full3[0] * full3[1] * c['d3'])
+        buffers['acc0'] = np.zeros(n * accumulator, np.float32)
+        buffers['acc1'] = np.zeros(n * full2[0] * full2[1] * c['d2'], np.float32)
+        self.full = {'d1': (n,) + full1 + (c['d1'],), 'd2': (n,) + full2 + (c['d2'],), 'd3': (n,) + full3 + (c['d3'],)}
+        for name, size in sizes.items():
+            buffers[name] = np.zeros(max(size, 1), np.float32)
+        # like the network's, the output is cropped to the multiple of 4 below the input size
+        buffers['output'] = np.zeros((n, h6, w6, c['d3']), np.float32)
+        self.shape = tuple(shape[:3])
+
+    def allocated_bytes(self):
+        return sum(b.nbytes for b in self.buffers.values())
+
+    def scratch(self, name, shape):
+        return self.buffers[name][:int(np.prod(shape))].reshape(shape)
+
+    def conv_(self, layer, src, stride):
+        """Convolution of the padded buffer `src` into a view of the GEMM output scratch."""
+        Wm = self.gemm_W[layer]
+        k = self.kernel(layer)
+        c_i = src.shape[3]
+        cols = im2col(src, k, k, stride)
+        n, h_o, w_o = cols.shape[:3]
+        y = self.scratch('gemm_out', (n, h_o, w_o, Wm.shape[1]))
+        band = self.bands[layer]
+        for i in range(n):
+            for r in range(0, h_o, band):
+                rows = min(band, h_o - r)
+                patch = self.scratch('cols', (rows, w_o, k, k, c_i))
+                np.copyto(patch, cols[i, r:r + rows])
+                np.dot(patch.reshape(rows * w_o, -1), Wm, out=y[i, r:r + rows].reshape(rows * w_o, -1))
+        y += self.params[layer + '_b']
+        return y
+
+    def deconv_(self, layer, x, acc, stride, pad):
+        """Transposed convolution of `x` accumulated in `acc`, returns the cropped view."""
+        Wm = self.gemm_W[layer]
+        k = self.kernel(layer)
+        n, h, w, c_i = x.shape
+        full = self.buffers[acc][:int(np.prod(self.full[layer]))].reshape(self.full[layer])
+        c_o = full.shape[3]
+        full.fill(0)
+        band = self.bands[layer]
+        for i in range(n):
+            for r in range(0, h, band):
+                rows = min(band, h - r)
+                xin = self.scratch('gemm_in', (rows, w, c_i))
+                np.copyto(xin, x[i, r:r + rows])
+                cols = self.scratch('cols', (rows * w, k * k * c_o))
+                np.dot(xin.reshape(rows * w, c_i), Wm, out=cols)
+                cols = cols.reshape(rows, w, k, k, c_o)
+                for a in range(k):
+                    for b in range(k):
+                        full[i, r * stride + a:(r + rows - 1) * stride + a + 1:stride,
+                             b:b + stride * w:stride] += cols[:, :, a, b]
+        y = interior(full, pad)
+        y += self.params[layer + '_b']
+        return y
+
+    def __call__(self, x, hook=None):
+        if tuple(x.shape[:3]) != self.shape:
+            self.plan(x.shape)
+        buffers = self.buffers
+
+        def observe(name, h):
+            if hook is not None:
+                hook(name, h)
+
+        def tmp(h):
+            return self.scratch('tmp', h.shape)
+
+        np.copyto(interior(buffers['c1_in'], 4), x)
+        for conv, bn, stride, dst in (('c1', 'b1', 1, 'c2_in'), ('c2', 'b2', 2, 'c3_in'), ('c3', 'b3', 2, 'trunk')):
+            src = {'c1': 'c1_in', 'c2': 'c2_in', 'c3': 'c3_in'}[conv]
+            h = self.conv_(conv, buffers[src], stride)
+            observe(conv, h)
+            h = batch_norm_(elu_(h, tmp(h)), *self.bn[bn], out=interior(buffers[dst], 1))
+            observe(bn, h)
+        trunk = interior(buffers['trunk'], 1)
+        for i in range(1, self.n_residual + 1):
+            name = 'r{}'.format(i)
+            h = self.conv_(name + '_c1', buffers['trunk'], 1)
+            h = batch_norm_(h, *self.bn[name + '_b1'], out=interior(buffers['residual'], 1))
+            np.maximum(h, 0, out=h)
+            h = self.conv_(name + '_c2', buffers['residual'], 1)
+            h = batch_norm_(h, *self.bn[name + '_b2'], out=h)
+            trunk += h
+            observe(name, trunk)
+        h = trunk
+        for deconv, bn, acc in (('d1', 'b4', 'acc0'), ('d2', 'b5', 'acc1')):
+            h = self.deconv_(deconv, h, acc, 2, 1)
+            observe(deconv, h)
+            h = batch_norm_(elu_(h, tmp(h)), *self.bn[bn], out=h)
+            observe(bn, h)
+        y = self.deconv_('d3', h, 'acc0', 1, 4)
+        observe('d3', y)
+        out = buffers['output']
+        np.tanh(y, out=out)
+        out += 1
+        out *= 127.5
+        return out
+
+def parse_size(s):
+    w, h = s.split('x')
+    return int(w), int(h)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the arena engine against NumpyStyleNet and time repeated calls')
+    parser.add_argument('model_data', help='directory of .dat files or weight bundle')
+    parser.add_argument('--size', default='512x512', type=parse_size, help='WxH')
+    parser.add_argument('--batchsize', '-b', default=1, type=int)
+    parser.add_argument('--repeat', '-r', default=5, type=int)
+    args = parser.parse_args()
+
+    params = load_params(args.model_data)
+    reference, model = NumpyStyleNet(params), ArenaStyleNet(params)
+    w, h = args.size
+    x = np.random.RandomState(0).uniform(0, 255, (args.batchsize, h, w, 3)).astype(np.float32)
+
+    for name, forward in (('numpy', reference), ('arena', model)):
+        forward(x)
+        start = time.time()
+        for _ in range(args.repeat):
+            forward(x)
+        print('{:<6} {:.1f} ms/call'.format(name, (time.time() - start) / args.repeat * 1000))
+    print('arena {:.1f} MB'.format(model.allocated_bytes() / 2. ** 20))
+
+    import tracemalloc
+    tracemalloc.start()
+    y = model(x)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('peak allocation during a planned call: {:.1f} KB'.format(peak / 1024.))
+    print('max abs error vs NumpyStyleNet: {:.2e}'.format(float(np.abs(y - reference(x)).max())))
+    # a size that is not a multiple of 4, whose output the network crops
+    x = x[:, :(h - 1) // 4 * 4 + 2, :(w - 1) // 4 * 4 + 2]
+    y, expected = model(x), reference(x)
+    if y.shape != expected.shape:
+        raise SystemExit('{}x{} input: output shape {} instead of {}'.format(
+            x.shape[2], x.shape[1], y.shape, expected.shape))
+    print('max abs error vs NumpyStyleNet at {}x{}: {:.2e}'.format(
+        x.shape[2], x.shape[1], float(np.abs(y - expected).max())))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+from __future__ import print_function
+import os
+import glob
+import multiprocessing
+
+import numpy as np
+from PIL import Image
+
+from inference import load_model, stylize, to_images
+from pipeline import prefetch, Sink
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+def expand_inputs(inputs):
+    """Resolves directories, glob patterns and @list files into a list of image paths."""
+    paths = []
+    for entry in inputs:
+        if entry.startswith('@'):
+            with open(entry[1:]) as f:
+                paths.extend(line.strip() for line in f if line.strip())
+        elif os.path.isdir(entry):
+            for fn in sorted(os.listdir(entry)):
+                if os.path.splitext(fn)[1].lower() in IMAGE_EXTENSIONS:
+                    paths.append(os.path.join(entry, fn))
+        elif glob.has_magic(entry):
+            paths.extend(sorted(glob.glob(entry)))
+        else:
+            paths.append(entry)
+    return paths
+
+def group_by_size(paths, batchsize):
+    # Image.open only parses the header, so this does not decode anything.
+    groups = {}
+    for path in paths:
+        groups.setdefault(Image.open(path).size, []).append(path)
+    batches = []
+    for size in sorted(groups):
+        group = groups[size]
+        for i in range(0, len(group), batchsize):
+            batches.append(group[i:i + batchsize])
+    return batches
+
+def decode(paths):
+    images = [np.asarray(Image.open(p).convert('RGB'), dtype=np.float32) for p in paths]
+    return np.stack(images).transpose(0, 3, 1, 2)
+
+def encode(item):
+    paths, result = item
+    for path, image in zip(paths, to_images(result)):
+        Image.fromarray(image).save(path)
+
+def output_paths(paths, out_dir):
+    return [os.path.join(out_dir, os.path.basename(p)) for p in paths]
+
+def check_output_names(paths):
+    """Raises ValueError if two inputs would be written to the same output file."""
+    seen = {}
+    for path in paths:
+        seen.setdefault(os.path.basename(path), []).append(path)
+    clashes = [group for group in seen.values() if len(group) > 1]
+    if clashes:
+        raise ValueError('inputs with the same file name would overwrite each other in the output directory: ' +
+                         '; '.join(', '.join(group) for group in clashes))
+
+def _run_worker(model_path, gpu, batches, out_dir, depth, test):
+    model = load_model(model_path, gpu)
+    decoded = prefetch(((paths, decode(paths)) for paths in batches), depth)
+    with Sink(encode, depth) as writer:
+        for paths, x in decoded:
+            writer.put((output_paths(paths, out_dir), stylize(model, x, test)))
+            print('{} images done ({})'.format(len(paths), ', '.join(os.path.basename(p) for p in paths)))
+
+def run(batches, model_path, out_dir, gpu=-1, workers=1, depth=2, test=True):
+    """Stylizes `batches` of same-size image paths, writing the results into `out_dir`.
+
+    Every worker process loads the model once and pipelines decode, forward and
+    encode so that the model is not kept waiting on PIL. `test` selects the
+    BatchNormalization mode as for inference.stylize. Outputs are named
+    after the inputs, so inputs with the same file name are rejected.
+    """
+    check_output_names([p for paths in batches for p in paths])
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    if workers <= 1:
+        _run_worker(model_path, gpu, batches, out_dir, depth, test)
+        return
+    processes = [multiprocessing.Process(target=_run_worker,
+                                         args=(model_path, gpu, batches[k::workers], out_dir, depth, test))
+                 for k in range(workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    failed = [p for p in processes if p.exitcode != 0]
+    if failed:
+        raise RuntimeError('{} of {} workers failed'.format(len(failed), workers))
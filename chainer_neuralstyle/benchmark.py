@@ -0,0 +1,210 @@
+"""Inference benchmark for FastStyleNet over input sizes, batch sizes and BLAS thread counts.
+
+BLAS libraries read their thread count when numpy is imported, so every
+thread count runs in a child process started with the corresponding
+environment. Results, including per-layer times, are written as JSON so
+that runs can be compared between commits.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import subprocess
+import collections
+
+THREAD_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS')
+
+def parse_size(s):
+    w, h = s.lower().split('x')
+    return int(w), int(h)
+
+class LayerClock(object):
+    """Accumulates wall time per layer name over one forward pass."""
+
+    def __init__(self):
+        self.times = collections.OrderedDict()
+        self.last = time.time()
+
+    def lap(self, name):
+        now = time.time()
+        self.times[name] = self.times.get(name, 0.) + now - self.last
+        self.last = now
+
+def chainer_runner(args):
+    from chainer import Variable
+    from net import FastStyleNet, load_style_net
+
+    model = load_style_net(args.model) if args.model else FastStyleNet(args.width, args.n_residual)
+
+    def forward(x, clock=None):
+        x = Variable(x.transpose(0, 3, 1, 2).copy(), volatile=True)
+        if clock is None:
+            return model(x, test=True)
+
+        def hook(name, h):
+            if name == 'input':
+                clock.last = time.time()
+            else:
+                clock.lap(name)
+
+        model.hooks.append(hook)
+        try:
+            return model(x, test=True)
+        finally:
+            model.hooks.remove(hook)
+
+    return forward
+
+def numpy_runner(args, arena=False, fft=False, fused=False):
+    from numpy_engine import NumpyStyleNet, load_params
+    if arena:
+        from arena import ArenaStyleNet
+        model = ArenaStyleNet(load_params(args.model_data))
+    elif fft:
+        from fft_conv import FFTStyleNet
+        model = FFTStyleNet(load_params(args.model_data))
+    elif fused:
+        from fused_residual import FusedStyleNet
+        model = FusedStyleNet(load_params(args.model_data))
+    else:
+        model = NumpyStyleNet(load_params(args.model_data))
+
+    def forward(x, clock=None):
+        if clock is None:
+            return model(x)
+        y = model(x, hook=lambda name, h: clock.lap(name))
+        clock.lap('output')
+        return y
+
+    return forward
+
+RUNNERS = {'chainer': chainer_runner, 'numpy': numpy_runner,
+           'arena': lambda args: numpy_runner(args, arena=True),
+           'fft': lambda args: numpy_runner(args, fft=True),
+           'fused': lambda args: numpy_runner(args, fused=True)}
+
+def summarize(times):
+    import numpy as np
+    t = np.asarray(times)
+    return {'trials': times, 'mean': float(t.mean()), 'median': float(np.median(t)),
+            'min': float(t.min()), 'std': float(t.std())}
+
+def run_worker(args):
+    import numpy as np
+    forward = RUNNERS[args.engine](args)
+    rng = np.random.RandomState(0)
+    records = []
+    for size in args.sizes:
+        w, h = parse_size(size)
+        for batchsize in args.batchsizes:
+            x = rng.uniform(0, 255, (batchsize, h, w, 3)).astype(np.float32)
+            for _ in range(args.warmup):
+                forward(x)
+            times = []
+            for _ in range(args.trials):
+                start = time.time()
+                forward(x)
+                times.append(time.time() - start)
+            record = summarize(times)
+            record.update({'engine': args.engine, 'threads': args.threads, 'width': w, 'height': h,
+                           'batchsize': batchsize, 'per_image': record['median'] / batchsize})
+            if args.layers:
+                layers = collections.defaultdict(list)
+                for _ in range(args.trials):
+                    clock = LayerClock()
+                    forward(x, clock)
+                    for name, t in clock.times.items():
+                        layers[name].append(t)
+                record['layers'] = collections.OrderedDict(
+                    (name, float(np.median(t))) for name, t in layers.items())
+            print('{} {}x{} batch {} threads {}: {:.3f} sec/batch, {:.3f} sec/image'.format(
+                args.engine, w, h, batchsize, args.threads, record['median'], record['per_image']),
+                file=sys.stderr)
+            records.append(record)
+    return records
+
+def git_revision():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def config_key(record):
+    return (record['engine'], record['threads'], record['width'], record['height'], record['batchsize'])
+
+def compare_results(baseline, records):
+    """Prints the median time of every configuration relative to a baseline run."""
+    old = dict((config_key(r), r) for r in baseline['results'])
+    for r in records:
+        key = config_key(r)
+        if key in old:
+            ratio = r['median'] / old[key]['median']
+            print('{} {}t {}x{} b{}: {:.3f} -> {:.3f} sec ({:+.1f}%)'.format(
+                key[0], key[1], key[2], key[3], key[4], old[key]['median'], r['median'], (ratio - 1) * 100))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark FastStyleNet inference')
+    parser.add_argument('--engine', default='chainer', choices=sorted(RUNNERS))
+    parser.add_argument('--model', '-m', default=None, type=str,
+                        help='chainer model to load (timings do not depend on the weights)')
+    parser.add_argument('--width', default=1.0, type=float,
+                        help='channel width multiplier of the chainer model built without --model')
+    parser.add_argument('--n_residual', default=5, type=int,
+                        help='residual blocks of the chainer model built without --model')
+    parser.add_argument('--model_data', '-d', default=None, type=str,
+                        help='.dat folder or weight bundle for the NumPy based engines')
+    parser.add_argument('--sizes', nargs='+', default=['256x256', '512x512', '1024x768'])
+    parser.add_argument('--batchsizes', nargs='+', type=int, default=[1, 4])
+    parser.add_argument('--threads', nargs='+', type=int, default=[1, 4])
+    parser.add_argument('--warmup', default=1, type=int)
+    parser.add_argument('--trials', default=5, type=int)
+    parser.add_argument('--no_layers', dest='layers', action='store_false', help='skip the per-layer timings')
+    parser.add_argument('--out', '-o', default='benchmark.json', type=str)
+    parser.add_argument('--baseline', '-b', default=None, type=str,
+                        help='earlier benchmark JSON to compare the results against')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.engine != 'chainer' and not args.model_data:
+        parser.error('--model_data is required for the {} engine'.format(args.engine))
+
+    if args.worker:
+        args.threads = args.threads[0]
+        json.dump(run_worker(args), sys.stdout)
+        return
+
+    records = []
+    for threads in args.threads:
+        env = dict(os.environ)
+        for var in THREAD_VARS:
+            env[var] = str(threads)
+        cmd = [sys.executable, os.path.abspath(__file__), '--worker', '--threads', str(threads),
+               '--engine', args.engine, '--warmup', str(args.warmup), '--trials', str(args.trials),
+               '--width', str(args.width), '--n_residual', str(args.n_residual),
+               '--sizes'] + args.sizes + ['--batchsizes'] + [str(b) for b in args.batchsizes]
+        # the workers run from this directory, so the paths are made absolute
+        if args.model:
+            cmd += ['--model', os.path.abspath(args.model)]
+        if args.model_data:
+            cmd += ['--model_data', os.path.abspath(args.model_data)]
+        if not args.layers:
+            cmd.append('--no_layers')
+        out = subprocess.check_output(cmd, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+        records += json.loads(out.decode('utf-8'))
+
+    result = {'revision': git_revision(), 'host': socket.gethostname(), 'platform': platform.platform(),
+              'python': platform.python_version(), 'cpu_count': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+              'timestamp': time.time(), 'results': records}
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=2)
+    print('wrote', args.out)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_results(json.load(f), records)
+
+if __name__ == '__main__':
+    main()
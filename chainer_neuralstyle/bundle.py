@@ -0,0 +1,170 @@
+"""Packed weight bundle: one file holding every tensor of an exported model.
+
+Layout: the 8 byte magic, the header length as a little-endian uint64, a
+JSON index and then the tensor payloads, each starting on a page boundary:
+
+    {"version": 1, "alignment": 4096,
+     "tensors": [{"name": ..., "dtype": "<f4", "shape": [...],
+                  "offset": ..., "nbytes": ..., "sha1": ...}, ...]}
+
+Offsets are absolute, so a reader maps the file once and hands out
+zero-copy views of the payloads.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import shutil
+import struct
+import hashlib
+
+import numpy as np
+
+MAGIC = b'NOBUNDLE'
+VERSION = 1
+ALIGNMENT = 4096
+
+def _align(n, alignment=ALIGNMENT):
+    return -(-n // alignment) * alignment
+
+def export_layout(data):
+    """Chainer parameter -> exported layout: 4-d kernels (c_o, c_i, h, w) become (c_o, h, w, c_i)."""
+    if data.ndim == 4:
+        data = data.transpose((0, 2, 3, 1))
+    return data
+
+def checksum(array):
+    return hashlib.sha1(np.ascontiguousarray(array).view(np.uint8)).hexdigest()
+
+def _header_bytes(index):
+    return json.dumps({'version': VERSION, 'alignment': ALIGNMENT, 'tensors': index},
+                      sort_keys=True).encode('utf-8')
+
+def build_index(tensors):
+    """Index entries for a list of (name, array), with offsets filled in."""
+    index = [{'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape),
+              'nbytes': int(array.nbytes), 'sha1': checksum(array), 'offset': 0}
+             for name, array in tensors]
+    # The header length depends on the offsets, so settle it on an upper bound.
+    for entry in index:
+        entry['offset'] = 10 ** 15
+    offset = _align(len(MAGIC) + 8 + len(_header_bytes(index)))
+    for entry in index:
+        entry['offset'] = offset
+        offset = _align(offset + entry['nbytes'])
+    return index
+
+def read_index(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a weight bundle'.format(path))
+        length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(length).decode('utf-8'))
+    if header['version'] != VERSION:
+        raise ValueError('unsupported bundle version {}'.format(header['version']))
+    return header['tensors']
+
+def _layout(index):
+    return [(e['name'], e['dtype'], e['shape'], e['offset'], e['nbytes']) for e in index]
+
+def _write_header(f, index):
+    header = _header_bytes(index)
+    f.seek(0)
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', len(header)))
+    f.write(header)
+
+def write_bundle(path, tensors):
+    """Writes (name, array) pairs to `path` and returns the number of payloads written.
+
+    The bundle is written to `path + '.tmp'` and renamed over `path`, so a
+    reader that maps the old file keeps its weights and a crash leaves the
+    old bundle intact. When `path` already holds a bundle with the same
+    names, dtypes and shapes, the temporary file starts as a copy of it and
+    only the tensors whose checksum changed are rewritten.
+    """
+    tensors = [(name, np.ascontiguousarray(array)) for name, array in tensors]
+    index = build_index(tensors)
+    previous = None
+    if os.path.exists(path):
+        try:
+            previous = read_index(path)
+        except ValueError:
+            pass
+
+    tmp_path = path + '.tmp'
+    if previous is not None and _layout(previous) == _layout(index):
+        shutil.copyfile(path, tmp_path)
+        mode = 'r+b'
+        changed = [entry['sha1'] != old['sha1'] for entry, old in zip(index, previous)]
+    else:
+        mode = 'wb'
+        changed = [True] * len(index)
+    with open(tmp_path, mode) as f:
+        for entry, (name, array), write in zip(index, tensors, changed):
+            if write:
+                f.seek(entry['offset'])
+                f.write(array.tobytes())
+        _write_header(f, index)
+        f.truncate(_align(index[-1]['offset'] + index[-1]['nbytes']) if index else f.tell())
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    return sum(changed)
+
+class Bundle(object):
+    """Read-only view of a weight bundle backed by a single memory map.
+
+    Tensors are materialized lazily as views into the map, nothing is copied.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = dict((e['name'], e) for e in read_index(path))
+        self.names = [e['name'] for e in sorted(self.index.values(), key=lambda e: e['offset'])]
+        self._map = np.memmap(path, dtype=np.uint8, mode='r')
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, name):
+        e = self.index[name]
+        payload = self._map[e['offset']:e['offset'] + e['nbytes']]
+        return payload.view(np.dtype(e['dtype'])).reshape(e['shape'])
+
+    def keys(self):
+        return list(self.names)
+
+    def items(self):
+        return [(name, self[name]) for name in self.names]
+
+    def verify(self):
+        """Names of the tensors whose payload does not match the recorded checksum."""
+        return [name for name in self.names if checksum(self[name]) != self.index[name]['sha1']]
+
+def main():
+    args = sys.argv[1:]
+    if len(args) == 3 and args[0] == 'pack':
+        from numpy_engine import load_dat_dir
+        params = load_dat_dir(args[1])
+        written = write_bundle(args[2], sorted(params.items()))
+        print('{}: {} of {} tensors written'.format(args[2], written, len(params)))
+    elif len(args) == 2 and args[0] == 'info':
+        bundle = Bundle(args[1])
+        for name in bundle:
+            e = bundle.index[name]
+            print('{:<16} {:<5} {:<20} @{}'.format(name, e['dtype'], str(tuple(e['shape'])), e['offset']))
+        corrupt = bundle.verify()
+        print('{} tensors, {}'.format(len(bundle), 'checksum mismatch: ' + ', '.join(corrupt) if corrupt else 'checksums ok'))
+    else:
+        print('usage: %s pack model-data-folder out.bundle | info file.bundle' % os.path.basename(__file__))
+        exit(-1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Checks the sub-pixel form of d1/d2 against the deconvolution.
+
+- the deconv_ground_truth.py fixtures: d1 of the r5 output, with the
+  exported d1 weights;
+- random inputs through d1 and d2 against numpy_engine.deconv2d;
+- the round trip of the weight transform.
+
+    python check_subpixel.py ../NeuralObscura/composition_model_data --testdata ../NeuralObscuraTests/testdata
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from numpy_engine import load_params, deconv2d, subpixel_weight, deconv_weight, subpixel_deconv2d
+
+def relative_error(expected, actual):
+    return float(np.abs(expected - actual).max() / max(np.abs(expected).max(), 1e-12))
+
+def check_fixtures(params, testdata):
+    # fixtures are channel-first without the batch axis: (128, h, w) -> (64, 2h, 2w)
+    x = np.load(os.path.join(testdata, 'deconv-test-data.npy')).transpose(1, 2, 0)[np.newaxis]
+    expected = np.load(os.path.join(testdata, 'deconv-ground-truth.npy')).transpose(1, 2, 0)[np.newaxis]
+    actual = subpixel_deconv2d(x, subpixel_weight(params['d1_W']), params['d1_b'])
+    return relative_error(expected, actual)
+
+def timed(f):
+    start = time.time()
+    y = f()
+    return y, time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Equivalence of the sub-pixel d1/d2 with the deconvolutions')
+    parser.add_argument('model_data', help='directory of .dat files or weight bundle, with deconvolution weights')
+    parser.add_argument('--testdata', default=None, type=str,
+                        help='folder with deconv-test-data.npy and deconv-ground-truth.npy')
+    parser.add_argument('--size', default=128, type=int, help='spatial size of the random d1 input')
+    parser.add_argument('--tol', default=1e-5, type=float, help='largest relative error accepted')
+    args = parser.parse_args()
+
+    params = load_params(args.model_data)
+    errors = []
+    if args.testdata:
+        errors.append(('fixture d1', check_fixtures(params, args.testdata)))
+
+    rng = np.random.RandomState(0)
+    h = rng.randn(1, args.size, args.size, params['d1_W'].shape[0]).astype(np.float32)
+    for layer in ('d1', 'd2'):
+        W, b = params[layer + '_W'], params[layer + '_b']
+        Wsp = subpixel_weight(W)
+        errors.append(('{} weight round trip'.format(layer), relative_error(W, deconv_weight(Wsp))))
+        expected, t_deconv = timed(lambda: deconv2d(h, W, b, 2, 1))
+        actual, t_subpixel = timed(lambda: subpixel_deconv2d(h, Wsp, b))
+        errors.append(('{} {}x{}'.format(layer, h.shape[1], h.shape[2]), relative_error(expected, actual)))
+        print('{}: deconvolution {:.1f} ms, sub-pixel {:.1f} ms'.format(layer, t_deconv * 1000, t_subpixel * 1000))
+        h = expected
+
+    failed = False
+    for name, error in errors:
+        ok = error <= args.tol
+        failed |= not ok
+        print('{:<24} relative error {:.2e} {}'.format(name, error, 'ok' if ok else 'FAILED'))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""Checkpoints written on a background thread.
+
+save() copies the parameters and optimizer state into host arrays (the only
+work on the training thread) and hands them to a writer thread, which
+writes a compressed npz next to the destination, fsyncs it and renames it
+into place, so a checkpoint file is either complete or absent. The `.state`
+file of a checkpoint is written after its `.model`, so a checkpoint counts as
+complete once its `.state` exists.
+
+Files follow train.py's names in `directory`: `<prefix>_<epoch>_<iteration>`
+for periodic checkpoints and `<prefix>_<epoch>` at the end of an epoch, each
+as `.model` and `.state`.
+"""
+import os
+import re
+import time
+
+import numpy as np
+from chainer import cuda, serializers
+
+from pipeline import Sink
+
+def snapshot(obj):
+    """Copies what serializers.save_npz would write for `obj` into host arrays."""
+    s = serializers.DictionarySerializer()
+    s.save(obj)
+    return dict((key, np.array(cuda.to_cpu(value))) for key, value in s.target.items())
+
+def write_npz(path, arrays):
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+def fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def list_checkpoints(directory, prefix):
+    """[(epoch, iteration or None, name)] of the complete checkpoints, oldest first."""
+    pattern = re.compile(r'^{}_(\d+)(?:_(\d+))?\.state$'.format(re.escape(prefix)))
+    found = []
+    for fn in os.listdir(directory) if os.path.isdir(directory) else []:
+        m = pattern.match(fn)
+        if m and os.path.exists(os.path.join(directory, fn[:-len('.state')] + '.model')):
+            iteration = None if m.group(2) is None else int(m.group(2))
+            found.append((int(m.group(1)), iteration, fn[:-len('.state')]))
+    # an epoch-end checkpoint comes after every periodic one of its epoch
+    return sorted(found, key=lambda c: (c[0], float('inf') if c[1] is None else c[1]))
+
+def latest_checkpoint(directory, prefix):
+    """(model path, state path, epoch, iteration) to continue from, or None.
+
+    The returned epoch and iteration are those of the next training step.
+    """
+    checkpoints = list_checkpoints(directory, prefix)
+    if not checkpoints:
+        return None
+    epoch, iteration, name = checkpoints[-1]
+    path = os.path.join(directory, name)
+    if iteration is None:
+        epoch, iteration = epoch + 1, 0
+    else:
+        iteration += 1
+    return path + '.model', path + '.state', epoch, iteration
+
+class CheckpointWriter(object):
+    """Saves model and optimizer pairs without blocking the training loop.
+
+    A checkpoint is due every `every` iterations and/or `interval` seconds.
+    With `keep` > 0 only the newest `keep` periodic checkpoints are kept,
+    the epoch-end ones are never removed. At most one checkpoint waits
+    behind the one being written.
+    """
+
+    def __init__(self, directory, prefix, every=0, interval=None, keep=0):
+        self.directory = directory
+        self.prefix = prefix
+        self.every = every
+        self.interval = interval
+        self.keep = keep
+        self.last = time.time()
+        self.sink = Sink(self._write, depth=1)
+
+    def due(self, iteration):
+        if self.every > 0 and iteration % self.every == 0:
+            return True
+        return self.interval is not None and time.time() - self.last >= self.interval
+
+    def save(self, name, model, optimizer, periodic=False):
+        self.last = time.time()
+        self.sink.put((name, snapshot(model), snapshot(optimizer), periodic))
+
+    def _write(self, item):
+        name, model, state, periodic = item
+        path = os.path.join(self.directory, name)
+        write_npz(path + '.model', model)
+        write_npz(path + '.state', state)
+        fsync_dir(self.directory)
+        if periodic and self.keep > 0:
+            self._prune()
+
+    def _prune(self):
+        periodic = [name for _, iteration, name in list_checkpoints(self.directory, self.prefix)
+                    if iteration is not None]
+        for name in periodic[:-self.keep]:
+            for ext in ('.state', '.model'):
+                try:
+                    os.remove(os.path.join(self.directory, name + ext))
+                except OSError:
+                    pass
+
+    def close(self):
+        """Waits for the pending checkpoints, raising any write error."""
+        self.sink.close()
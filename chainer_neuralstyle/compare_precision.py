@@ -0,0 +1,85 @@
+"""Per-layer and final-image error of reduced-precision inference against float32."""
+from __future__ import print_function
+import os
+import glob
+import json
+import argparse
+
+import numpy as np
+from PIL import Image
+
+from numpy_engine import NumpyStyleNet, load_params
+
+def psnr(reference, actual, peak=None):
+    if peak is None:
+        peak = float(np.abs(reference).max())
+    mse = float(np.mean((np.asarray(reference, np.float64) - np.asarray(actual, np.float64)) ** 2))
+    if mse == 0:
+        return float('inf')
+    return 10 * np.log10(peak ** 2 / mse)
+
+def compare(reference, model, x):
+    """Runs both models on `x` and returns [(layer, max_abs, psnr)], with 'image' last."""
+    activations = {}
+    expected = reference(x, hook=lambda name, h: activations.__setitem__(name, h))
+    rows = []
+
+    def check(name, h):
+        ref = activations.pop(name)
+        rows.append((name, float(np.abs(ref - h.astype(np.float32)).max()), psnr(ref, h)))
+
+    actual = model(x, hook=check)
+    expected, actual = np.uint8(expected), np.uint8(actual)
+    rows.append(('image', float(np.abs(expected.astype(np.int16) - actual).max()), psnr(expected, actual, 255.)))
+    return rows
+
+def load_image(path, max_size=None):
+    image = Image.open(path).convert('RGB')
+    if max_size and max(image.size) > max_size:
+        scale = float(max_size) / max(image.size)
+        image = image.resize((int(image.size[0] * scale), int(image.size[1] * scale)), Image.BILINEAR)
+    return np.asarray(image, dtype=np.float32)[np.newaxis]
+
+def report(results):
+    """Prints the worst error of every layer over all images and returns it as a dict."""
+    worst = {}
+    order = []
+    for rows in results.values():
+        for name, max_abs, p in rows:
+            if name not in worst:
+                order.append(name)
+                worst[name] = {'max_abs': max_abs, 'psnr': p}
+            else:
+                worst[name]['max_abs'] = max(worst[name]['max_abs'], max_abs)
+                worst[name]['psnr'] = min(worst[name]['psnr'], p)
+    print('{:<8} {:>12} {:>10}'.format('layer', 'max abs', 'PSNR dB'))
+    for name in order:
+        print('{:<8} {:>12.6f} {:>10.2f}'.format(name, worst[name]['max_abs'], worst[name]['psnr']))
+    return dict((name, worst[name]) for name in order)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare float16 against float32 FastStyleNet inference')
+    parser.add_argument('model_data', help='directory of .dat files or weight bundle (float32)')
+    parser.add_argument('images', nargs='*', help='images to run (default: sample_images/*)')
+    parser.add_argument('--max_size', default=None, type=int, help='downscale images to this longest side')
+    parser.add_argument('--json', default=None, type=str, help='write the per-image and worst-case errors here')
+    args = parser.parse_args()
+
+    images = args.images or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_images', '*')))
+    params = load_params(args.model_data)
+    reference = NumpyStyleNet(params, np.float32)
+    half = NumpyStyleNet(params, np.float16)
+
+    results = {}
+    for path in images:
+        results[path] = compare(reference, half, load_image(path, args.max_size))
+        name, max_abs, p = results[path][-1]
+        print('{}: image max abs {:.0f}, PSNR {:.2f} dB'.format(path, max_abs, p))
+    worst = report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'images': dict((k, [list(r) for r in v]) for k, v in results.items()), 'worst': worst},
+                      f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
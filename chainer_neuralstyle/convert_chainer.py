@@ -1,16 +1,24 @@
 import os
 import sys
+import argparse
 import numpy as np
 from net import *
+from fold import FoldedStyleNet, FoldedInputLinear, ChannelAffine
 from chainer import serializers
 import itertools
+from bundle import write_bundle, export_layout
+from numpy_engine import subpixel_weight
 
 class ChainerDataReader(object):
-    def __init__(self, data_path):
+    def __init__(self, data_path, fold=False, subpixel=False):
         self.data_path = data_path
         self.model_name = os.path.splitext(os.path.basename(data_path))[0]
-        self.model = FastStyleNet()
+        self.model = FastStyleNet(**saved_config(data_path))
         self.load_using_chainer()
+        if fold:
+            self.fold()
+        if subpixel:
+            self.subpixel()
 
     def load_using_chainer(self):
         print("Loading the chainer model.")
@@ -34,19 +42,37 @@ class ChainerDataReader(object):
             for param in child.namedparams():
                 self.parameters.append((rename_layer(child.name, param[0]), param[1].data))
 
+    def fold(self):
+        # Replaces the parameters with the ones of the BatchNormalization-free network.
+        # Layers whose input BatchNormalization was folded also carry `_shift_W`, the
+        # kernel of their input-size dependent bias map (see FoldedInputLinear).
+        folded = FoldedStyleNet(self.model)
+        self.parameters = [(name.lstrip('/').replace('/', '_'), param.data) for name, param in folded.namedparams()]
+        for child in folded.children():
+            if isinstance(child, FoldedInputLinear):
+                self.parameters.append((child.name + '_shift_W', child.shift_W))
+            if isinstance(child, ChannelAffine):
+                self.parameters.append((child.name + '_scale', child.scale))
+                self.parameters.append((child.name + '_shift', child.shift))
+        self.parameters.sort()
 
-    def dump(self, dst_path):
-        params = []
-        def convert(data):
-            if data.ndim == 4:
-                # Original VGG form (c_o, c_i, h, w) -> (c_o, h, w, c_i)
-                data = data.transpose((0, 2, 3, 1))
-            return data
+    def subpixel(self):
+        # Replaces the 4x4 stride-2 deconvolutions d1/d2 by `_sp_W`, a 2x2 convolution (pad 1)
+        # whose 4 * c_o outputs are the pixel-shuffle phases (see numpy_engine.subpixel_weight).
+        # Kept in chainer's (c_o, c_i, h, w) order here, export_layout() makes it (c_o, h, w, c_i).
+        parameters = []
+        for key, data in self.parameters:
+            if key in ('d1_W', 'd2_W'):
+                key, data = key[:-len('_W')] + '_sp_W', subpixel_weight(export_layout(data)).transpose(0, 3, 1, 2)
+            parameters.append((key, data))
+        self.parameters = parameters
 
+    def dump(self, dst_path, dtype=np.float32):
+        params = []
         s = ""
         for key, data in self.parameters:
             print(key)
-            data = convert(data)
+            data = export_layout(data).astype(dtype)
             s += ("  modelParams[\"%s\"] = FileParameterBuffer(modelName: modelName, rawFileName: \"%s\")\n" % (key, key))
             s += ("  //%s shape = %s\n" % (key, data.shape))
 
@@ -59,13 +85,29 @@ class ChainerDataReader(object):
         print(s)
         print("Done!")
 
+    def dump_bundle(self, dst_path, dtype=np.float32):
+        tensors = [(key, export_layout(data).astype(dtype)) for key, data in self.parameters]
+        written = write_bundle(dst_path, tensors)
+        print("%s: %d of %d tensors written, the others were unchanged" % (dst_path, written, len(tensors)))
+
 def main():
-    args = sys.argv[1:]
-    if len(args) != 2:
-        print("usage: %s chainer.model output-folder" % os.path.basename(__file__))
-        exit(-1)
-    data_path, dst_path = args
-    ChainerDataReader(data_path).dump(dst_path)
+    parser = argparse.ArgumentParser(description='Export a chainer FastStyleNet model as raw parameter files')
+    parser.add_argument('model', help='chainer .model file')
+    parser.add_argument('output', help='output folder, or output file with --bundle')
+    parser.add_argument('--fold', action='store_true',
+                        help='fold the BatchNormalization layers into the convolution weights')
+    parser.add_argument('--subpixel', action='store_true',
+                        help='export d1 and d2 as sub-pixel convolutions (d1_sp_W, d2_sp_W) instead of deconvolutions')
+    parser.add_argument('--bundle', action='store_true',
+                        help='write a single memory-mappable weight bundle instead of one .dat file per parameter')
+    parser.add_argument('--dtype', default='float32', choices=('float32', 'float16'),
+                        help='storage precision of the exported parameters')
+    args = parser.parse_args()
+    reader = ChainerDataReader(args.model, fold=args.fold, subpixel=args.subpixel)
+    if args.bundle:
+        reader.dump_bundle(args.output, args.dtype)
+    else:
+        reader.dump(args.output, args.dtype)
 
 if __name__ == '__main__':
     main()
@@ -2,16 +2,18 @@
 
 import os
 import sys
+import argparse
 import numpy as np
 from net import *
 from chainer import serializers
 import itertools
+from bundle import write_bundle, export_layout
 
 class ChainerDataReader(object):
     def __init__(self, data_path):
         self.data_path = data_path
         self.model_name = os.path.splitext(os.path.basename(data_path))[0]
-        self.model = FastStyleNet()
+        self.model = FastStyleNet(**saved_config(data_path))
         self.load_using_chainer()
 
     def load_using_chainer(self):
@@ -26,18 +28,12 @@ class ChainerDataReader(object):
         self.parameters = list(itertools.chain(*[[( rename_layer(child.name, param[0]), param[1].data) for param in child.namedparams()] for child in children]))
 
 
-    def dump(self, dst_path):
+    def dump(self, dst_path, dtype=np.float32):
         params = []
-        def convert(data):
-            if data.ndim == 4:
-                # Original VGG form (c_o, c_i, h, w) -> (c_o, h, w, c_i)
-                data = data.transpose((0, 2, 3, 1))
-            return data
-
         s = ""
         for key, data in self.parameters:
             print(key)
-            data = convert(data)
+            data = export_layout(data).astype(dtype)
             s += ("  modelParams[\"%s\"] = StyleModelData(modelName: modelName, rawFileName: \"%s\")\n" % (key, key))
             s += ("  //%s shape = %s\n" % (key, data.shape))
 
@@ -50,13 +46,25 @@ class ChainerDataReader(object):
         print(s)
         print("Done!")
 
+    def dump_bundle(self, dst_path, dtype=np.float32):
+        tensors = [(key, export_layout(data).astype(dtype)) for key, data in self.parameters]
+        written = write_bundle(dst_path, tensors)
+        print("%s: %d of %d tensors written, the others were unchanged" % (dst_path, written, len(tensors)))
+
 def main():
-    args = sys.argv[1:]
-    if len(args) != 2:
-        print("usage: %s chainer.model output-folder" % os.path.basename(__file__))
-        exit(-1)
-    data_path, dst_path = args
-    ChainerDataReader(data_path).dump(dst_path)
+    parser = argparse.ArgumentParser(description='Export a chainer FastStyleNet model as raw parameter files')
+    parser.add_argument('model', help='chainer .model file')
+    parser.add_argument('output', help='output folder, or output file with --bundle')
+    parser.add_argument('--bundle', action='store_true',
+                        help='write a single memory-mappable weight bundle instead of one .dat file per parameter')
+    parser.add_argument('--dtype', default='float32', choices=('float32', 'float16'),
+                        help='storage precision of the exported parameters')
+    args = parser.parse_args()
+    reader = ChainerDataReader(args.model)
+    if args.bundle:
+        reader.dump_bundle(args.output, args.dtype)
+    else:
+        reader.dump(args.output, args.dtype)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,93 @@
+"""On-disk cache of the VGG content targets used by train.py.
+
+The content loss only uses conv3_3 of the training image, which depends on
+nothing but the image, its crop size and the VGG weights. Entries are .npy
+files named after a hash of those three, read back memory mapped, and the
+least recently used ones are evicted once the cache exceeds its size cap.
+"""
+import os
+import time
+import hashlib
+
+import numpy as np
+
+def hash_file(path, chunk=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class FeatureCache(object):
+    def __init__(self, cache_dir, vgg_hash, image_size, dtype=np.float16, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.vgg_hash = vgg_hash
+        self.image_size = image_size
+        self.dtype = np.dtype(dtype)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # file name -> [size, last access], seeded from the files left by earlier runs
+        self.entries = {}
+        for fn in os.listdir(cache_dir):
+            if fn.endswith('.npy'):
+                st = os.stat(os.path.join(cache_dir, fn))
+                self.entries[fn] = [st.st_size, st.st_mtime]
+        self.total_bytes = sum(e[0] for e in self.entries.values())
+
+    def _name(self, path):
+        key = '{}:{}:{}:{}'.format(os.path.abspath(path), self.image_size, self.vgg_hash, self.dtype.str)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy'
+
+    def get(self, path):
+        fn = self._name(path)
+        entry = self.entries.get(fn)
+        if entry is None:
+            self.misses += 1
+            return None
+        try:
+            feature = np.load(os.path.join(self.cache_dir, fn), mmap_mode='r')
+        except (IOError, ValueError):
+            self._remove(fn)
+            self.misses += 1
+            return None
+        # the file time keeps the recency for later runs
+        entry[1] = time.time()
+        os.utime(os.path.join(self.cache_dir, fn), None)
+        self.hits += 1
+        return feature
+
+    def put(self, path, feature):
+        fn = self._name(path)
+        if fn in self.entries:
+            return
+        feature = np.asarray(feature, dtype=self.dtype)
+        if self.max_bytes is not None and feature.nbytes > self.max_bytes:
+            return
+        dst = os.path.join(self.cache_dir, fn)
+        tmp = dst + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, feature)
+        os.rename(tmp, dst)
+        st = os.stat(dst)
+        self.entries[fn] = [st.st_size, st.st_mtime]
+        self.total_bytes += st.st_size
+        self._evict()
+
+    def _remove(self, fn):
+        size, _ = self.entries.pop(fn)
+        self.total_bytes -= size
+        try:
+            os.remove(os.path.join(self.cache_dir, fn))
+        except OSError:
+            pass
+
+    def _evict(self):
+        if self.max_bytes is None or self.total_bytes <= self.max_bytes:
+            return
+        for fn in sorted(self.entries, key=lambda fn: self.entries[fn][1]):
+            self._remove(fn)
+            if self.total_bytes <= self.max_bytes:
+                break
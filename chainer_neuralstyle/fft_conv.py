@@ -0,0 +1,160 @@
+"""FFT convolution for the large stride-1 layers (c1: 3->32 and d3: 32->3, 9x9).
+
+The image is cut into blocks of FFT_BLOCK x FFT_BLOCK outputs; each block
+reads its (block + k - 1)^2 input tile, is multiplied with the kernel
+spectrum and transformed back (overlap-save, the circular wrap-around only
+touches the discarded border). A stride-1 deconvolution is a convolution
+with the spatially flipped, transposed kernel and padding k - 1 - pad.
+
+    python fft_conv.py composition.bundle --sizes 256 512 1024 2048
+    python fft_conv.py composition.bundle --model models/composition.model
+
+The first prints the per-layer times of both paths and the crossover size,
+with --model the FFT layers are also checked against chainer's links.
+"""
+from __future__ import print_function
+import time
+import argparse
+
+import numpy as np
+
+from numpy_engine import NumpyStyleNet, load_params, conv2d, deconv2d, pad_hw
+
+# Outputs per block side; with a 9x9 kernel the transforms are 128x128.
+FFT_BLOCK = 120
+
+def kernel_spectrum(W, size):
+    """(c_o, k, k, c_i) correlation kernel -> (size, size // 2 + 1, c_i, c_o) spectrum."""
+    flipped = np.asarray(W, dtype=np.float32)[:, ::-1, ::-1, :].transpose(1, 2, 3, 0)
+    return np.fft.rfft2(flipped, s=(size, size), axes=(0, 1))
+
+def deconv_as_conv(W):
+    """Stride-1 deconvolution weight (c_i, k, k, c_o) -> convolution weight (c_o, k, k, c_i)."""
+    return np.ascontiguousarray(np.asarray(W)[:, ::-1, ::-1, :].transpose(3, 1, 2, 0))
+
+def fft_conv2d(x, W, b, pad=0, block=FFT_BLOCK, spectrum=None):
+    """Stride-1 convolution, same arguments and result as numpy_engine.conv2d."""
+    c_o, k, _, c_i = W.shape
+    size = block + k - 1
+    if spectrum is None:
+        spectrum = kernel_spectrum(W, size)
+    x = pad_hw(np.asarray(x, dtype=np.float32), pad)
+    n, h, w, _ = x.shape
+    h_o, w_o = h - k + 1, w - k + 1
+    y = np.empty((n, h_o, w_o, c_o), dtype=np.float32)
+    for i in range(n):
+        for r in range(0, h_o, block):
+            rows = min(block, h_o - r)
+            # one row of tiles per transform, zero-extended to full tiles
+            strip = np.zeros((size, w_o + block + k - 1, c_i), dtype=np.float32)
+            strip[:rows + k - 1, :w] = x[i, r:r + rows + k - 1]
+            n_tiles = (w_o + block - 1) // block
+            tiles = np.stack([strip[:, t * block:t * block + size] for t in range(n_tiles)])
+            X = np.fft.rfft2(tiles, axes=(1, 2))
+            # per frequency a (1, c_i) x (c_i, c_o) product, batched by matmul
+            Y = np.matmul(X[..., np.newaxis, :], spectrum)[..., 0, :]
+            out = np.fft.irfft2(Y, s=(size, size), axes=(1, 2))[:, k - 1:, k - 1:]
+            for t in range(n_tiles):
+                cols = min(block, w_o - t * block)
+                y[i, r:r + rows, t * block:t * block + cols] = out[t, :rows, :cols]
+    if b is not None:
+        y += b
+    return y
+
+def fft_deconv2d(x, W, b, pad=0, block=FFT_BLOCK, spectrum=None):
+    """Stride-1 deconvolution, same arguments and result as numpy_engine.deconv2d."""
+    W = deconv_as_conv(W)
+    return fft_conv2d(x, W, b, W.shape[1] - 1 - pad, block, spectrum)
+
+class FFTStyleNet(NumpyStyleNet):
+    """NumpyStyleNet running the stride-1 layers in `fft_layers` through the FFT path."""
+
+    def __init__(self, params, dtype=np.float32, fft_layers=('c1', 'd3'), block=FFT_BLOCK, subpixel=None):
+        super(FFTStyleNet, self).__init__(params, dtype, subpixel)
+        self.block = block
+        self.spectra = {}
+        for layer in fft_layers:
+            W = self.params[layer + '_W']
+            if layer.startswith('d'):
+                W = deconv_as_conv(W)
+            self.spectra[layer] = kernel_spectrum(W, block + W.shape[1] - 1)
+
+    def conv(self, name, x, stride, pad):
+        if name not in self.spectra or stride != 1:
+            return super(FFTStyleNet, self).conv(name, x, stride, pad)
+        return self.store(fft_conv2d(x, self.params[name + '_W'], self.params[name + '_b'], pad,
+                                     self.block, self.spectra[name]))
+
+    def deconv(self, name, x, stride, pad):
+        if name not in self.spectra or stride != 1:
+            return super(FFTStyleNet, self).deconv(name, x, stride, pad)
+        return self.store(fft_deconv2d(x, self.params[name + '_W'], self.params[name + '_b'], pad,
+                                       self.block, self.spectra[name]))
+
+def check_chainer(model_path, params, size=64):
+    """Max abs difference, relative to the largest output, of the FFT c1/d3 from
+    chainer's Convolution2D/Deconvolution2D."""
+    from chainer import Variable
+    from net import load_style_net
+
+    model = load_style_net(model_path)
+    rng = np.random.RandomState(0)
+    x = rng.uniform(0, 255, (1, size, size, 3)).astype(np.float32)
+    expected = model.c1(Variable(x.transpose(0, 3, 1, 2), volatile=True)).data.transpose(0, 2, 3, 1)
+    # weights from the model itself, in the exported channel-last layout
+    c1_W = model.c1.W.data.transpose(0, 2, 3, 1)
+    errors = {'c1': np.abs(fft_conv2d(x, c1_W, model.c1.b.data, 4) - expected).max() / np.abs(expected).max()}
+    h = rng.randn(1, size, size, params['d3_W'].shape[0]).astype(np.float32)
+    expected = model.d3(Variable(h.transpose(0, 3, 1, 2), volatile=True)).data.transpose(0, 2, 3, 1)
+    d3_W = model.d3.W.data.transpose(0, 2, 3, 1)
+    errors['d3'] = np.abs(fft_deconv2d(h, d3_W, model.d3.b.data, 4) - expected).max() / np.abs(expected).max()
+    return errors
+
+def best_time(f, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        f()
+        times.append(time.time() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='FFT vs im2col timing of the 9x9 layers, and a check against chainer')
+    parser.add_argument('model_data', help='directory of .dat files or weight bundle')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[128, 256, 512, 1024])
+    parser.add_argument('--block', default=FFT_BLOCK, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--model', '-m', default=None, type=str,
+                        help='chainer model of the same weights to check the FFT layers against')
+    args = parser.parse_args()
+
+    params = load_params(args.model_data)
+    if args.model:
+        for layer, error in sorted(check_chainer(args.model, params).items()):
+            print('{} relative error vs chainer: {:.2e}'.format(layer, error))
+
+    rng = np.random.RandomState(0)
+    print('{:<6} {:>6} {:>12} {:>12} {:>10}'.format('layer', 'size', 'im2col ms', 'fft ms', 'rel err'))
+    crossover = {}
+    for size in args.sizes:
+        x = rng.uniform(0, 255, (1, size, size, 3)).astype(np.float32)
+        h = rng.randn(1, size, size, params['d3_W'].shape[0]).astype(np.float32)
+        cases = (
+            ('c1', lambda: conv2d(x, params['c1_W'], params['c1_b'], 1, 4),
+                   lambda: fft_conv2d(x, params['c1_W'], params['c1_b'], 4, args.block)),
+            ('d3', lambda: deconv2d(h, params['d3_W'], params['d3_b'], 1, 4),
+                   lambda: fft_deconv2d(h, params['d3_W'], params['d3_b'], 4, args.block)),
+        )
+        for layer, direct, fft in cases:
+            expected = direct()
+            error = np.abs(expected - fft()).max() / np.abs(expected).max()
+            t_direct, t_fft = best_time(direct, args.repeat), best_time(fft, args.repeat)
+            print('{:<6} {:>6} {:>12.1f} {:>12.1f} {:>10.2e}'.format(layer, size, t_direct * 1000, t_fft * 1000, error))
+            if t_fft < t_direct:
+                crossover.setdefault(layer, size)
+    for layer in ('c1', 'd3'):
+        print('{}: FFT faster from {}'.format(layer, '{}px'.format(crossover[layer]) if layer in crossover
+                                                    else 'none of the sizes'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+from __future__ import print_function
+import argparse
+
+import numpy as np
+from PIL import Image
+import chainer
+import chainer.links as L
+import chainer.functions as F
+from chainer import cuda, Variable, serializers
+from net import *
+
+def bn_affine(bn):
+    # test-mode BatchNormalization as a per-channel y = scale * x + shift
+    std = np.sqrt(cuda.to_cpu(bn.avg_var) + bn.eps)
+    scale = cuda.to_cpu(bn.gamma.data) / std
+    shift = cuda.to_cpu(bn.beta.data) - cuda.to_cpu(bn.avg_mean) * scale
+    return scale.astype(np.float32), shift.astype(np.float32)
+
+def linear_like(layer, W, b):
+    """A new Convolution2D/Deconvolution2D with the geometry of `layer` and the given weights."""
+    if isinstance(layer, L.Deconvolution2D):
+        n_in, n_out, kh, kw = W.shape
+        new = L.Deconvolution2D(n_in, n_out, (kh, kw), stride=layer.stride, pad=layer.pad)
+    else:
+        n_out, n_in, kh, kw = W.shape
+        new = L.Convolution2D(n_in, n_out, (kh, kw), stride=layer.stride, pad=layer.pad)
+    new.W.data[...] = W
+    new.b.data[...] = b
+    return new
+
+def fold_output_bn(layer, bn):
+    """Folds a BatchNormalization applied to the output of `layer` into its weights."""
+    scale, shift = bn_affine(bn)
+    W, b = cuda.to_cpu(layer.W.data), cuda.to_cpu(layer.b.data)
+    if isinstance(layer, L.Deconvolution2D):
+        W = W * scale[None, :, None, None]
+    else:
+        W = W * scale[:, None, None, None]
+    return linear_like(layer, W, b * scale + shift)
+
+class FoldedInputLinear(chainer.Link):
+    """Convolution or deconvolution whose input went through a BatchNormalization.
+
+    The per-channel scale of the normalization is folded into W. Its shift is a
+    constant input, so it only adds a bias map, but the map is not uniform: it
+    drops next to the zero-padded borders and alternates between phases for
+    stride-2 deconvolutions. It is computed once per input size from `shift_W`,
+    the weights contracted with the shift, and cached.
+    """
+
+    def __init__(self, layer, bn):
+        scale, shift = bn_affine(bn)
+        W, b = cuda.to_cpu(layer.W.data), cuda.to_cpu(layer.b.data)
+        super(FoldedInputLinear, self).__init__(W=W.shape, b=b.shape)
+        self.deconv = isinstance(layer, L.Deconvolution2D)
+        self.stride = layer.stride
+        self.pad = layer.pad
+        if self.deconv:
+            # (c_i, c_o, h, w)
+            self.W.data[...] = W * scale[:, None, None, None]
+            shift_W = np.einsum('iokl,i->okl', W, shift)[None]
+        else:
+            # (c_o, c_i, h, w)
+            self.W.data[...] = W * scale[None, :, None, None]
+            shift_W = np.einsum('oikl,i->okl', W, shift)[:, None]
+        self.b.data[...] = b
+        self.add_persistent('shift_W', shift_W.astype(np.float32))
+        self._bias_maps = {}
+
+    def _linear(self, x, W):
+        if self.deconv:
+            return F.deconvolution_2d(x, W, stride=self.stride, pad=self.pad)
+        return F.convolution_2d(x, W, stride=self.stride, pad=self.pad)
+
+    def bias_map(self, x):
+        size = x.data.shape[2:]
+        if size not in self._bias_maps:
+            xp = cuda.get_array_module(x.data)
+            ones = Variable(xp.ones((1, 1) + size, dtype=xp.float32), volatile=True)
+            m = self._linear(ones, Variable(self.shift_W, volatile=True)).data
+            self._bias_maps[size] = m + self.b.data.reshape((1, -1, 1, 1))
+        return self._bias_maps[size]
+
+    def to_cpu(self):
+        self._bias_maps = {}
+        return super(FoldedInputLinear, self).to_cpu()
+
+    def to_gpu(self, device=None):
+        self._bias_maps = {}
+        return super(FoldedInputLinear, self).to_gpu(device)
+
+    def __call__(self, x):
+        y = self._linear(x, self.W)
+        return y + F.broadcast_to(Variable(self.bias_map(x), volatile=x.volatile), y.data.shape)
+
+class ChannelAffine(chainer.Link):
+    def __init__(self, bn):
+        super(ChannelAffine, self).__init__()
+        scale, shift = bn_affine(bn)
+        self.add_persistent('scale', scale)
+        self.add_persistent('shift', shift)
+
+    def __call__(self, x):
+        shape = (1, -1, 1, 1)
+        scale = F.broadcast_to(Variable(self.scale.reshape(shape), volatile=x.volatile), x.data.shape)
+        shift = F.broadcast_to(Variable(self.shift.reshape(shape), volatile=x.volatile), x.data.shape)
+        return x * scale + shift
+
+class FoldedResidualBlock(chainer.Chain):
+    def __init__(self, block):
+        super(FoldedResidualBlock, self).__init__(
+            c1=fold_output_bn(block.c1, block.b1),
+            c2=fold_output_bn(block.c2, block.b2),
+        )
+
+    def __call__(self, x, test=True):
+        h = F.relu(self.c1(x))
+        return self.c2(h) + x
+
+class FoldedStyleNet(chainer.Chain):
+    """Inference-only FastStyleNet with its BatchNormalization layers folded away.
+
+    The residual blocks fold b1/b2 into their own convolutions. In the trunk
+    each BatchNormalization follows an ELU, so b1, b2, b4 and b5 fold into the
+    input side of c2, c3, d2 and d3. b3 feeds both r1 and its skip connection,
+    so it stays as a per-channel scale and shift.
+    """
+
+    def __init__(self, model):
+        W, b = cuda.to_cpu(model.c1.W.data), cuda.to_cpu(model.c1.b.data)
+        dW, db = cuda.to_cpu(model.d1.W.data), cuda.to_cpu(model.d1.b.data)
+        links = dict(
+            c1=linear_like(model.c1, W, b),
+            c2=FoldedInputLinear(model.c2, model.b1),
+            c3=FoldedInputLinear(model.c3, model.b2),
+            b3=ChannelAffine(model.b3),
+            d1=linear_like(model.d1, dW, db),
+            d2=FoldedInputLinear(model.d2, model.b4),
+            d3=FoldedInputLinear(model.d3, model.b5),
+        )
+        for name in model.residual_names:
+            links[name] = FoldedResidualBlock(model[name])
+        super(FoldedStyleNet, self).__init__(**links)
+        self.residual_names = model.residual_names
+
+    def __call__(self, x, test=True):
+        h = F.elu(self.c1(x))
+        h = F.elu(self.c2(h))
+        h = self.b3(F.elu(self.c3(h)))
+        for name in self.residual_names:
+            h = self[name](h)
+        h = F.elu(self.d1(h))
+        h = F.elu(self.d2(h))
+        y = self.d3(h)
+        return (F.tanh(y)+1)*127.5
+
+def max_abs_error(model, folded, x):
+    x = Variable(x, volatile=True)
+    expected = cuda.to_cpu(model(x, test=True).data)
+    actual = cuda.to_cpu(folded(x).data)
+    return float(np.abs(expected - actual).max())
+
+def main():
+    parser = argparse.ArgumentParser(description='Fold BatchNormalization into the FastStyleNet weights')
+    parser.add_argument('model')
+    parser.add_argument('--image', '-i', default=None, type=str,
+                        help='image used for the tolerance check (default: random 256x256 input)')
+    parser.add_argument('--out', '-o', default=None, type=str, help='save the folded model to this path')
+    parser.add_argument('--tol', default=1e-2, type=float,
+                        help='maximum absolute difference tolerated on the 0-255 output')
+    args = parser.parse_args()
+
+    model = load_style_net(args.model)
+    folded = FoldedStyleNet(model)
+
+    if args.image:
+        x = np.asarray(Image.open(args.image).convert('RGB'), dtype=np.float32).transpose(2, 0, 1)[np.newaxis]
+    else:
+        x = np.random.RandomState(0).uniform(0, 255, (1, 3, 256, 256)).astype(np.float32)
+    error = max_abs_error(model, folded, x)
+    print('max abs error against the unfolded model: {:.6f}'.format(error))
+    if error > args.tol:
+        raise SystemExit('folded model exceeds the tolerance of {}'.format(args.tol))
+
+    if args.out:
+        serializers.save_npz(args.out, folded)
+        print('saved', args.out)
+
+if __name__ == '__main__':
+    main()
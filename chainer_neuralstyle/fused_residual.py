@@ -0,0 +1,161 @@
+"""Fused, cache-blocked executor for the residual blocks (CPU inference, float32).
+
+The trunk lives in zero-bordered channel-last buffers (n, h + 3, w + 2, c):
+one padding row/column on every side plus one spare row. Flattened to
+((h + 3) * (w + 2), c), a 3x3 convolution over a run of rows is the sum of
+nine GEMMs, one per tap, each reading a contiguous slice shifted by
+row * (w + 2) + column; the two border columns come out as garbage and are
+dropped. No im2col buffer is needed.
+
+A block streams row bands: the first convolution (BatchNormalization folded
+into its weights, ReLU applied in place) fills a small rolling buffer of
+band + 2 rows, whose last two rows are carried over to the next band, and
+the second convolution writes the band straight into the output trunk
+buffer together with the skip-add. Per block this reads the input trunk and
+writes the output trunk once; the intermediate rows stay in cache.
+"""
+from __future__ import print_function
+import time
+import argparse
+
+import numpy as np
+
+from numpy_engine import NumpyStyleNet, load_params, bn_params
+
+# Size of one band of the intermediate activation, kept well inside L2.
+FUSED_BAND_BYTES = 1024 * 1024
+
+def fold_conv_bn(W, b, scale, shift):
+    """(c_o, 3, 3, c_i) convolution followed by BatchNormalization -> (9, c_i, c_o) taps and bias."""
+    c_o, kh, kw, c_i = W.shape
+    taps = np.asarray(W, dtype=np.float32).transpose(1, 2, 3, 0).reshape(kh * kw, c_i, c_o) * scale
+    return np.ascontiguousarray(taps, dtype=np.float32), (b * scale + shift).astype(np.float32)
+
+def band_rows(w, c, band_bytes=FUSED_BAND_BYTES):
+    return max(2, band_bytes // ((w + 2) * c * 4))
+
+def conv3x3_wide(src, start, rows, stride, taps, out, tmp):
+    """3x3 convolution of `rows` rows of the flattened padded buffer `src`, whose
+    window tops start at flat row `start`, into `out` ((rows * stride, c_o), wide layout)."""
+    length = rows * stride
+    for t in range(9):
+        offset = start + (t // 3) * stride + t % 3
+        if t == 0:
+            np.dot(src[offset:offset + length], taps[t], out=out)
+        else:
+            np.dot(src[offset:offset + length], taps[t], out=tmp[:length])
+            out += tmp[:length]
+    return out
+
+def fused_residual_block(src, dst, block, band, scratch):
+    """One block on a single image: padded (h + 3, w + 2, c) `src` -> interior of `dst`."""
+    taps1, bias1, taps2, bias2 = block
+    h, w = src.shape[0] - 3, src.shape[1] - 2
+    c = src.shape[2]
+    stride = w + 2
+    x = src.reshape(-1, c)
+    # h1[i] holds row r - 1 + i of the first convolution's output, zero padded like src
+    h1 = scratch['h1'].reshape(band + 3, stride, c)
+    h1_flat = h1.reshape(-1, c)
+    acc, tmp = scratch['acc'], scratch['tmp']
+
+    def first_conv(row, count, at):
+        # rows [row, row + count) of relu(bn(conv1)) into h1 starting at row `at`
+        base = at * stride + 1
+        out = conv3x3_wide(x, row * stride, count, stride, taps1, h1_flat[base:base + count * stride], tmp)
+        out += bias1
+        np.maximum(out, 0, out=out)
+
+    for r in range(0, h, band):
+        rows = min(band, h - r)
+        if r == 0:
+            h1[0] = 0
+            first_conv(0, min(rows + 1, h), 1)
+        else:
+            h1[0:2] = h1[band:band + 2]
+            first_conv(r + 1, min(rows, h - r - 1), 2)
+        if r + rows == h:
+            h1[rows + 1] = 0  # the zero padding below the image
+        h1[:, 0] = 0
+        h1[:, stride - 1] = 0
+        out = conv3x3_wide(h1_flat, 0, rows, stride, taps2, acc[:rows * stride], tmp)
+        out += bias2
+        out = out.reshape(rows, stride, c)[:, :w]
+        np.add(out, src[r + 1:r + 1 + rows, 1:w + 1], out=dst[r + 1:r + 1 + rows, 1:w + 1])
+
+class FusedStyleNet(NumpyStyleNet):
+    """NumpyStyleNet whose residual blocks run through fused_residual_block.
+
+    The block outputs are views into two ping-pong trunk buffers, valid
+    until the next block runs.
+    """
+
+    def __init__(self, params, dtype=np.float32, band_bytes=FUSED_BAND_BYTES, subpixel=None):
+        super(FusedStyleNet, self).__init__(params, dtype, subpixel)
+        self.band_bytes = band_bytes
+        self.blocks = {}
+        for i in range(1, self.n_residual + 1):
+            name = 'r{}'.format(i)
+            block = ()
+            for conv, bn in (('_c1', '_b1'), ('_c2', '_b2')):
+                block += fold_conv_bn(params[name + conv + '_W'], params[name + conv + '_b'],
+                                      *bn_params(params, name + bn))
+            self.blocks[name] = block
+        self.trunk = None
+        self.output = None
+
+    def plan(self, shape):
+        n, h, w, c = shape
+        self.band = band_rows(w, c, self.band_bytes)
+        self.trunk = [np.zeros((n, h + 3, w + 2, c), dtype=np.float32) for _ in range(2)]
+        self.scratch = {'h1': np.zeros((self.band + 3) * (w + 2) * c, dtype=np.float32),
+                        'acc': np.empty((self.band * (w + 2), c), dtype=np.float32),
+                        'tmp': np.empty(((self.band + 1) * (w + 2), c), dtype=np.float32)}
+
+    def residual(self, name, x):
+        if self.dtype != np.float32:
+            return super(FusedStyleNet, self).residual(name, x)
+        n, h, w, c = x.shape
+        if self.trunk is None or self.trunk[0].shape != (n, h + 3, w + 2, c):
+            self.plan(x.shape)
+            self.output = None
+        src, dst = self.trunk
+        if x is not self.output:
+            src[:, 1:h + 1, 1:w + 1] = x
+        for i in range(n):
+            fused_residual_block(src[i], dst[i], self.blocks[name], self.band, self.scratch)
+        self.trunk = [dst, src]
+        self.output = dst[:, 1:h + 1, 1:w + 1]
+        return self.output
+
+def main():
+    parser = argparse.ArgumentParser(description='Check and time the fused residual blocks against NumpyStyleNet')
+    parser.add_argument('model_data', help='directory of .dat files or weight bundle')
+    parser.add_argument('--size', default=512, type=int, help='input image size (the trunk is size / 4)')
+    parser.add_argument('--repeat', default=3, type=int)
+    args = parser.parse_args()
+
+    params = load_params(args.model_data)
+    reference, fused = NumpyStyleNet(params), FusedStyleNet(params)
+    c = params['c3_b'].shape[0]
+    x = np.random.RandomState(0).randn(1, args.size // 4, args.size // 4, c).astype(np.float32)
+
+    def trunk(model):
+        h = x
+        for i in range(1, model.n_residual + 1):
+            h = model.residual('r{}'.format(i), h)
+        return h
+
+    expected, actual = trunk(reference), trunk(fused)
+    print('max abs error {:.2e} (output max {:.2f})'.format(float(np.abs(expected - actual).max()),
+                                                            float(np.abs(expected).max())))
+    for label, model in (('numpy', reference), ('fused', fused)):
+        times = []
+        for _ in range(args.repeat):
+            start = time.time()
+            trunk(model)
+            times.append(time.time() - start)
+        print('{:<6} {:.1f} ms for {} blocks'.format(label, min(times) * 1000, model.n_residual))
+
+if __name__ == '__main__':
+    main()
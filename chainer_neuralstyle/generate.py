@@ -1,34 +1,106 @@
 from __future__ import print_function
 import numpy as np
+import os
 import argparse
 from PIL import Image
 import time
 
 import chainer
-from chainer import cuda, Variable, serializers
+from chainer import cuda, Variable
 from net import *
+import batch
+import tiling
+import preview
+from inference import stylize, BN_MODES
 
 parser = argparse.ArgumentParser(description='Real-time style transfer image generator')
-parser.add_argument('input')
+parser.add_argument('input', nargs='+',
+                    help='input image; a directory, glob pattern, @list file or several paths select batch mode')
 parser.add_argument('--gpu', '-g', default=-1, type=int,
                     help='GPU ID (negative value indicates CPU)')
 parser.add_argument('--model', '-m', default='models/style.model', type=str)
-parser.add_argument('--out', '-o', default='out.jpg', type=str)
+parser.add_argument('--out', '-o', default=None, type=str,
+                    help='output image (default out.jpg), or output directory in batch mode (default out)')
+parser.add_argument('--batchsize', '-b', default=4, type=int,
+                    help='maximum number of same-size images per forward in batch mode')
+parser.add_argument('--workers', '-w', default=1, type=int,
+                    help='number of worker processes in batch mode, each holding its own model')
+parser.add_argument('--prefetch', default=2, type=int,
+                    help='number of batches decoded ahead of the model in batch mode')
+parser.add_argument('--bn', default='batch', choices=BN_MODES,
+                    help='BatchNormalization statistics used by every mode: of each image as in training (default), '
+                         'or the running ones saved with the model (needed for tiling to be exact)')
+parser.add_argument('--tile', '-t', default=0, type=int,
+                    help='run the model over tiles of this size to bound memory (0 disables tiling)')
+parser.add_argument('--halo', default=None, type=int,
+                    help='context pixels around each tile (default covers the receptive field of the model, {}px with 5 residual blocks)'.format(tiling.default_halo()))
+parser.add_argument('--overlap', default=16, type=int,
+                    help='pixels over which neighbouring tiles are feather-blended')
+parser.add_argument('--tile_workers', default=1, type=int,
+                    help='number of tiles processed in parallel')
+parser.add_argument('--preview', '-p', default=0, type=float,
+                    help='run the network at 1/N resolution and upsample guided by the input, for a quick preview')
+parser.add_argument('--refine', action='store_true',
+                    help='after the preview, overwrite the output with successively finer results up to full resolution')
 args = parser.parse_args()
+test = args.bn == 'running'
 
-model = FastStyleNet()
-serializers.load_npz(args.model, model)
+paths = batch.expand_inputs(args.input)
+if len(paths) != 1 or paths[0] != args.input[0]:
+    start = time.time()
+    batches = batch.group_by_size(paths, args.batchsize)
+    batch.run(batches, args.model, args.out or 'out', args.gpu, args.workers, args.prefetch, test)
+    elapsed = time.time() - start
+    print(elapsed, 'sec for', len(paths), 'images', '({:.3f} sec/image)'.format(elapsed / max(len(paths), 1)))
+    exit(0)
+
+model = load_style_net(args.model)
 if args.gpu >= 0:
     cuda.get_device(args.gpu).use()
     model.to_gpu()
 xp = np if args.gpu < 0 else cuda.cupy
+if args.halo is None:
+    # the receptive field, and so the default halo, grows with the number of residual blocks
+    args.halo = tiling.default_halo(tiling.fast_style_layers(model.n_residual))
+
+def save(path, result):
+    # written next to the destination and renamed, so that a viewer never reads a partial image
+    root, ext = os.path.splitext(path)
+    tmp = '{}.tmp{}'.format(root, ext)
+    Image.fromarray(np.uint8(np.clip(result, 0, 255).transpose(1, 2, 0))).save(tmp)
+    os.rename(tmp, path)
+
+if args.preview > 1:
+    start = time.time()
+    out = args.out or 'out.jpg'
+    forward = lambda x: stylize(model, x, test)
+    image = np.asarray(Image.open(args.input[0]).convert('RGB'), dtype=np.float32).transpose(2, 0, 1)
+
+    def update(factor, result):
+        save(out, result)
+        print(time.time() - start, 'sec', '(1/{:g} resolution)'.format(factor) if factor > 1 else '(full resolution)')
+
+    update(args.preview, preview.preview(forward, image, args.preview))
+    if args.refine:
+        preview.Refinement(forward, image, preview.refinement_factors(args.preview), update).join()
+    exit(0)
+
+if args.tile > 0:
+    start = time.time()
+    image = np.asarray(Image.open(args.input[0]).convert('RGB'), dtype=np.float32).transpose(2, 0, 1)
+    result = tiling.tiled_stylize(lambda x: stylize(model, x, test), image, args.tile,
+                                  args.halo, args.overlap, args.tile_workers)
+    result = np.uint8(result.transpose(1, 2, 0))
+    print(time.time() - start, 'sec')
+    Image.fromarray(result).save(args.out or 'out.jpg')
+    exit(0)
 
 start = time.time()
-image = xp.asarray(Image.open(args.input).convert('RGB'), dtype=xp.float32).transpose(2, 0, 1)
+image = xp.asarray(Image.open(args.input[0]).convert('RGB'), dtype=xp.float32).transpose(2, 0, 1)
 image = image.reshape((1,) + image.shape)
-x = Variable(image)
+x = Variable(image, volatile=test)
 
-y = model(x)
+y = model(x, test=test)
 result = cuda.to_cpu(y.data)
 
 result = result.transpose(0, 2, 3, 1)
@@ -36,4 +108,4 @@ result = result.reshape((result.shape[1:]))
 result = np.uint8(result)
 print(time.time() - start, 'sec')
 
-Image.fromarray(result).save(args.out)
+Image.fromarray(result).save(args.out or 'out.jpg')
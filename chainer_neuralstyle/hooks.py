@@ -0,0 +1,78 @@
+"""Per-layer instrumentation through FastStyleNet.hooks (or NumpyStyleNet's hook argument).
+
+    recorder = LayerRecorder(keep_activations=True)
+    with recorder.attached(model):
+        model(x, test=True)
+    recorder.print_summary()
+    recorder.save('activations.npz')
+"""
+from __future__ import print_function
+import time
+import contextlib
+import collections
+
+import numpy as np
+
+def to_numpy(h):
+    data = h if isinstance(h, np.ndarray) else h.data
+    if not isinstance(data, np.ndarray):
+        data = data.get()  # cupy
+    return data
+
+class LayerRecorder(object):
+    """Records wall time, output shape, summary statistics and optionally the
+    activations of every layer in a single forward pass.
+
+    The time of a layer is measured from the previous hook call, the time
+    spent on the statistics themselves is excluded. NumpyStyleNet does not
+    report 'input', so call start() before its forward pass.
+    """
+
+    def __init__(self, keep_activations=False, stats=True):
+        self.keep_activations = keep_activations
+        self.stats = stats
+        self.records = collections.OrderedDict()
+        self.activations = collections.OrderedDict()
+        self.last = None
+
+    def __call__(self, name, h):
+        now = time.time()
+        record = {'time': 0. if self.last is None or name == 'input' else now - self.last}
+        data = to_numpy(h)
+        record['shape'] = data.shape
+        if self.stats:
+            record.update(min=float(data.min()), max=float(data.max()),
+                          mean=float(data.mean()), std=float(data.std()))
+        if self.keep_activations:
+            self.activations[name] = data.copy()
+        self.records[name] = record
+        self.last = time.time()
+
+    def start(self):
+        """Marks the start of a pass, for callers that do not report 'input'."""
+        self.last = time.time()
+
+    @contextlib.contextmanager
+    def attached(self, model):
+        model.hooks.append(self)
+        try:
+            yield self
+        finally:
+            model.hooks.remove(self)
+
+    def total_time(self):
+        return sum(r['time'] for r in self.records.values())
+
+    def print_summary(self):
+        print('{:<12} {:>9} {:<20} {:>12} {:>12} {:>12} {:>12}'.format(
+            'layer', 'ms', 'shape', 'min', 'max', 'mean', 'std'))
+        for name, r in self.records.items():
+            line = '{:<12} {:>9.2f} {:<20}'.format(name, r['time'] * 1000, str(tuple(r['shape'])))
+            if self.stats:
+                line += ' {:>12.4f} {:>12.4f} {:>12.4f} {:>12.4f}'.format(r['min'], r['max'], r['mean'], r['std'])
+            print(line)
+        print('total {:.2f} ms'.format(self.total_time() * 1000))
+
+    def save(self, path):
+        """Writes the kept activations to a compressed npz, keyed by layer name ('/' -> '_')."""
+        np.savez_compressed(path, **dict((name.replace('/', '_'), a) for name, a in self.activations.items()))
@@ -0,0 +1,183 @@
+"""Preprocessed training-image cache and prefetching batch loader for train.py.
+
+The cache holds the center-cropped training images as uint8 (n, size, size, 3)
+shards saved as .npy files, which are memory mapped at training time, plus a
+manifest.json listing the source paths in cache order.
+"""
+from __future__ import print_function
+import os
+import json
+import argparse
+import collections
+import itertools
+import multiprocessing
+
+import numpy as np
+from PIL import Image
+
+from pipeline import prefetch
+
+MANIFEST = 'manifest.json'
+
+def list_images(dataset_dir):
+    imagepaths = []
+    for fn in sorted(os.listdir(dataset_dir)):
+        base, ext = os.path.splitext(fn)
+        if ext == '.jpg' or ext == '.png':
+            imagepaths.append(os.path.join(dataset_dir, fn))
+    return imagepaths
+
+def crop_image(path, size):
+    """Upscales images smaller than `size` and crops the center size x size square."""
+    image = Image.open(path).convert('RGB')
+    w,h = image.size
+    if w < h:
+        if w < size:
+            image = image.resize((size, size*h//w))
+            w, h = image.size
+    else:
+        if h < size:
+            image = image.resize((size*w//h, size))
+            w, h = image.size
+    image = image.crop(((w-size)*0.5, (h-size)*0.5, (w+size)*0.5, (h+size)*0.5))
+    return np.asarray(image, dtype=np.uint8)
+
+def _crop(args):
+    return crop_image(*args)
+
+def build_cache(imagepaths, cache_dir, size, shard_size=4096, workers=4):
+    """Decodes and crops every image once and writes the shards and the manifest."""
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    shards = []
+    pool = multiprocessing.Pool(workers)
+    try:
+        images = pool.imap(_crop, [(path, size) for path in imagepaths], chunksize=16)
+        for start in range(0, len(imagepaths), shard_size):
+            count = min(shard_size, len(imagepaths) - start)
+            fn = 'shard_{:05d}.npy'.format(len(shards))
+            shard = np.lib.format.open_memmap(os.path.join(cache_dir, fn), mode='w+',
+                                              dtype=np.uint8, shape=(count, size, size, 3))
+            for j in range(count):
+                shard[j] = next(images)
+            shard.flush()
+            del shard
+            shards.append({'file': fn, 'count': count})
+            print('cached {}/{} images'.format(start + count, len(imagepaths)))
+    finally:
+        pool.close()
+        pool.join()
+    manifest = {'image_size': size, 'shards': shards, 'paths': imagepaths}
+    tmp_path = os.path.join(cache_dir, MANIFEST + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.rename(tmp_path, os.path.join(cache_dir, MANIFEST))
+    return manifest
+
+class CachedImages(object):
+    """Cropped uint8 training images read from the memory-mapped shards of a cache."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+        self.image_size = manifest['image_size']
+        self.paths = manifest['paths']
+        self.counts = [s['count'] for s in manifest['shards']]
+        self.files = [s['file'] for s in manifest['shards']]
+        self.offsets = np.cumsum([0] + self.counts)
+        self._shards = None
+
+    @staticmethod
+    def exists(cache_dir):
+        return os.path.exists(os.path.join(cache_dir, MANIFEST))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, i):
+        if self._shards is None:
+            self._shards = [np.load(os.path.join(self.cache_dir, fn), mmap_mode='r') for fn in self.files]
+        s = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        return self._shards[s][i - self.offsets[s]]
+
+class ImageFiles(object):
+    """Decodes and crops images on access, for training without a cache."""
+
+    def __init__(self, paths, image_size):
+        self.paths = paths
+        self.image_size = image_size
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        return crop_image(self.paths[i], self.image_size)
+
+def assemble(images, indices):
+    x = np.empty((len(indices), 3, images.image_size, images.image_size), dtype=np.float32)
+    for j, i in enumerate(indices):
+        x[j] = images[i].transpose(2, 0, 1)
+    return x
+
+_worker_images = None
+
+def _init_worker(images):
+    global _worker_images
+    _worker_images = images
+
+def _assemble(indices):
+    return assemble(_worker_images, indices)
+
+class PrefetchLoader(object):
+    """Assembles float32 (b, 3, size, size) batches ahead of the training step.
+
+    With `workers` > 0 the batches are built by that many processes, keeping at
+    most `depth` batches in flight; otherwise a background thread builds them.
+    """
+
+    def __init__(self, images, workers=2, depth=4):
+        self.images = images
+        self.workers = workers
+        self.depth = depth
+        self.pool = None
+        if workers > 0:
+            self.pool = multiprocessing.Pool(workers, _init_worker, (images,))
+
+    def batches(self, batch_indices):
+        if self.pool is None:
+            for x in prefetch((assemble(self.images, indices) for indices in batch_indices), self.depth):
+                yield x
+            return
+        batch_indices = iter(batch_indices)
+        pending = collections.deque(self.pool.apply_async(_assemble, (indices,))
+                                    for indices in itertools.islice(batch_indices, self.depth))
+        while pending:
+            x = pending.popleft().get()
+            for indices in itertools.islice(batch_indices, 1):
+                pending.append(self.pool.apply_async(_assemble, (indices,)))
+            yield x
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+def main():
+    parser = argparse.ArgumentParser(description='Preprocess a training dataset into a memory-mapped cache')
+    parser.add_argument('--dataset', '-d', default='dataset', type=str)
+    parser.add_argument('--cache', '-c', required=True, type=str, help='cache directory to write')
+    parser.add_argument('--image_size', default=256, type=int)
+    parser.add_argument('--shard_size', default=4096, type=int, help='images per shard')
+    parser.add_argument('--workers', '-w', default=4, type=int)
+    args = parser.parse_args()
+    build_cache(list_images(args.dataset), args.cache, args.image_size, args.shard_size, args.workers)
+
+if __name__ == '__main__':
+    main()
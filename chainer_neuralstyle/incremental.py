@@ -0,0 +1,121 @@
+"""Incremental stylization of frame sequences: only the regions that changed are recomputed.
+
+Each frame is compared with the input the cached output was computed from,
+tile by tile. Output pixels within the receptive-field radius of a changed
+tile are recomputed from a crop that adds the same halo of context, the
+rest of the output is reused. With running BatchNormalization statistics
+the network is translation invariant on its stride grid, so with the
+default halo a recomputed region equals the whole-frame forward; drift can
+only come from changes below the threshold, and periodic keyframes (full
+forwards) bound it.
+"""
+import numpy as np
+
+from tiling import ALIGN, crop_span, default_halo
+
+def dirty_tiles(frame, reference, tile, threshold):
+    """(rows, cols) boolean grid of the tiles whose largest per-pixel change exceeds `threshold`."""
+    diff = np.abs(frame - reference).max(axis=0)
+    h, w = diff.shape
+    rows, cols = -(-h // tile), -(-w // tile)
+    padded = np.zeros((rows * tile, cols * tile), dtype=diff.dtype)
+    padded[:h, :w] = diff
+    return padded.reshape(rows, tile, cols, tile).max(axis=(1, 3)) > threshold
+
+def _overlap(a, b):
+    return a[0] < b[1] and b[0] < a[1] and a[2] < b[3] and b[2] < a[3]
+
+def dirty_boxes(grid, tile, halo, height, width):
+    """Output boxes (y0, y1, x0, x1) to recompute for the dirty tiles of `grid`.
+
+    Every horizontal run of dirty tiles is grown by `halo` pixels, aligned to
+    the stride grid and clipped to the output; boxes that overlap are merged
+    into their bounding box.
+    """
+    boxes = []
+    for r in range(grid.shape[0]):
+        c = 0
+        while c < grid.shape[1]:
+            if not grid[r, c]:
+                c += 1
+                continue
+            start = c
+            while c < grid.shape[1] and grid[r, c]:
+                c += 1
+            box = (r * tile - halo, (r + 1) * tile + halo, start * tile - halo, c * tile + halo)
+            boxes.append((max(box[0] // ALIGN * ALIGN, 0), min(-(-box[1] // ALIGN) * ALIGN, height),
+                          max(box[2] // ALIGN * ALIGN, 0), min(-(-box[3] // ALIGN) * ALIGN, width)))
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                if _overlap(boxes[i], boxes[j]):
+                    a, b = boxes[i], boxes.pop(j)
+                    boxes[i] = (min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3]))
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+class IncrementalStylizer(object):
+    """Stylizes the frames of one stream, reusing the output of unchanged regions.
+
+    `forward` maps a (1, 3, h, w) float32 array to its (1, 3, h, w) stylized
+    output, as for tiling.tiled_stylize. A tile of `tile` pixels is dirty
+    once some pixel of it differs by more than `threshold` (0-255, largest
+    channel) from the input its output was computed from. Every
+    `keyframe_interval` frames (0 disables) and whenever the frame size
+    changes the whole frame is recomputed. A `halo` smaller than the default,
+    which covers the receptive field, trades exactness for speed.
+    """
+
+    def __init__(self, forward, tile=32, threshold=8., keyframe_interval=60, halo=None):
+        self.forward = forward
+        self.tile = tile
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self.halo = default_halo() if halo is None else halo
+        self.reference = None
+        self.output = None
+        self.frames = 0
+        self.keyframes = 0
+        self.recomputed = []
+
+    def keyframe(self, frame):
+        self.reference = frame.copy()
+        self.output = self.forward(frame[np.newaxis])[0]
+        self.keyframes += 1
+        self.recomputed.append(1.)
+        return self.output
+
+    def __call__(self, frame):
+        """(3, H, W) float32 frame -> (3, h, w) stylized output, cropped to the stride grid like the network's."""
+        frame = np.asarray(frame, dtype=np.float32)
+        self.frames += 1
+        if (self.reference is None or self.reference.shape != frame.shape or
+                (self.keyframe_interval > 0 and (self.frames - 1) % self.keyframe_interval == 0)):
+            return self.keyframe(frame).copy()
+
+        _, height, width = frame.shape
+        out_h, out_w = self.output.shape[1:]
+        grid = dirty_tiles(frame, self.reference, self.tile, self.threshold)
+        area = 0
+        for y0, y1, x0, x1 in dirty_boxes(grid, self.tile, self.halo, out_h, out_w):
+            c0, c1 = crop_span(y0, y1, out_h, self.halo)
+            d0, d1 = crop_span(x0, x1, out_w, self.halo)
+            crop = frame[:, c0:c1 if c1 < out_h else height, d0:d1 if d1 < out_w else width]
+            y = self.forward(crop[np.newaxis])[0]
+            self.output[:, y0:y1, x0:x1] = y[:, y0 - c0:y1 - c0, x0 - d0:x1 - d0]
+            area += (y1 - y0) * (x1 - x0)
+        # only the dirty tiles take the new input as reference, so that slow
+        # changes elsewhere keep accumulating against the input they were computed from
+        mask = np.repeat(np.repeat(grid, self.tile, axis=0), self.tile, axis=1)[:height, :width]
+        self.reference[:, mask] = frame[:, mask]
+        self.recomputed.append(float(area) / (out_h * out_w))
+        return self.output.copy()
+
+    def summary(self):
+        return {'frames': self.frames, 'keyframes': self.keyframes, 'tile': self.tile, 'threshold': self.threshold,
+                'halo': self.halo, 'recomputed_fraction': float(np.mean(self.recomputed)) if self.recomputed else 0.}
@@ -0,0 +1,31 @@
+import numpy as np
+
+from chainer import cuda, Variable
+from net import *
+
+def load_model(path, gpu=-1):
+    model = load_style_net(path)
+    if gpu >= 0:
+        cuda.get_device(gpu).use()
+        model.to_gpu()
+    return model
+
+# BatchNormalization modes of generate.py --bn: the statistics of each image,
+# as in training, or the running statistics saved with the model.
+BN_MODES = ('batch', 'running')
+
+def stylize(model, images, test=True):
+    # images: float32 array of shape (n, 3, h, w) holding RGB values in [0, 255].
+    # test=True normalizes with the running statistics, test=False with the
+    # statistics of each image. Either way images sharing a batch do not
+    # influence each other: with test=False every image is its own forward.
+    if not test and len(images) > 1:
+        return np.concatenate([stylize(model, images[i:i + 1], test) for i in range(len(images))])
+    xp = cuda.get_array_module(model.c1.W.data)
+    x = Variable(xp.asarray(images, dtype=xp.float32), volatile=test)
+    y = model(x, test=test)
+    return cuda.to_cpu(y.data)
+
+def to_images(result):
+    # (n, 3, h, w) float output -> list of (h, w, 3) uint8 arrays
+    return [np.uint8(y.transpose(1, 2, 0)) for y in result]
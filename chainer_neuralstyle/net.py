@@ -4,7 +4,7 @@ import numpy as np
 import chainer
 import chainer.links as L
 import chainer.functions as F
-from chainer import Variable
+from chainer import Variable, serializers
 
 class ResidualBlock(chainer.Chain):
     def __init__(self, n_in, n_out, stride=1, ksize=3):
@@ -16,9 +16,16 @@ class ResidualBlock(chainer.Chain):
             b2=L.BatchNormalization(n_out)
         )
 
-    def __call__(self, x, test):
-        h = F.relu(self.b1(self.c1(x), test=test))
-        h = self.b2(self.c2(h), test=test)
+    def __call__(self, x, test, observe=None):
+        if observe is None:
+            h = F.relu(self.b1(self.c1(x), test=test))
+            h = self.b2(self.c2(h), test=test)
+        else:
+            h = observe('c1', self.c1(x))
+            h = observe('b1', self.b1(h, test=test))
+            h = observe('relu', F.relu(h))
+            h = observe('c2', self.c2(h))
+            h = observe('b2', self.b2(h, test=test))
         if x.data.shape != h.data.shape:
             xp = chainer.cuda.get_array_module(x.data)
             n, c, hh, ww = x.data.shape
@@ -30,62 +37,125 @@ class ResidualBlock(chainer.Chain):
                 x = F.average_pooling_2d(x, 1, 2)
         return h + x
 
+# Channels of c1, c2 and c3 (and of d2, d1 and the residual blocks) at width 1.
+STYLE_CHANNELS = (32, 64, 128)
+
+def style_channels(width=1.0):
+    return tuple(max(1, int(round(c * width))) for c in STYLE_CHANNELS)
+
 class FastStyleNet(chainer.Chain):
-    def __init__(self):
-        super(FastStyleNet, self).__init__(
-            c1=L.Convolution2D(3, 32, 9, stride=1, pad=4),
-            c2=L.Convolution2D(32, 64, 4, stride=2, pad=1),
-            c3=L.Convolution2D(64, 128, 4,stride=2, pad=1),
-            r1=ResidualBlock(128, 128),
-            r2=ResidualBlock(128, 128),
-            r3=ResidualBlock(128, 128),
-            r4=ResidualBlock(128, 128),
-            r5=ResidualBlock(128, 128),
-            d1=L.Deconvolution2D(128, 64, 4, stride=2, pad=1),
-            d2=L.Deconvolution2D(64, 32, 4, stride=2, pad=1),
-            d3=L.Deconvolution2D(32, 3, 9, stride=1, pad=4),
-            b1=L.BatchNormalization(32),
-            b2=L.BatchNormalization(64),
-            b3=L.BatchNormalization(128),
-            b4=L.BatchNormalization(64),
-            b5=L.BatchNormalization(32),
+    """Transformation network; `width` scales the channel counts and
+    `n_residual` is the number of residual blocks (1.0 and 5 in the paper).
+
+    Both are written with the parameters, see load_style_net.
+    """
+
+    def __init__(self, width=1.0, n_residual=5):
+        n1, n2, n3 = style_channels(width)
+        links = dict(
+            c1=L.Convolution2D(3, n1, 9, stride=1, pad=4),
+            c2=L.Convolution2D(n1, n2, 4, stride=2, pad=1),
+            c3=L.Convolution2D(n2, n3, 4,stride=2, pad=1),
+            d1=L.Deconvolution2D(n3, n2, 4, stride=2, pad=1),
+            d2=L.Deconvolution2D(n2, n1, 4, stride=2, pad=1),
+            d3=L.Deconvolution2D(n1, 3, 9, stride=1, pad=4),
+            b1=L.BatchNormalization(n1),
+            b2=L.BatchNormalization(n2),
+            b3=L.BatchNormalization(n3),
+            b4=L.BatchNormalization(n2),
+            b5=L.BatchNormalization(n1),
         )
+        for i in range(1, n_residual + 1):
+            links['r{}'.format(i)] = ResidualBlock(n3, n3)
+        super(FastStyleNet, self).__init__(**links)
+        self.width = width
+        self.n_residual = n_residual
+        self.residual_names = ['r{}'.format(i) for i in range(1, n_residual + 1)]
+        # Callables invoked as hook(name, variable) after every operation of the
+        # forward pass, starting with 'input'; see hooks.LayerRecorder.
+        self.hooks = []
+
+    def serialize(self, serializer):
+        super(FastStyleNet, self).serialize(serializer)
+        try:
+            serializer('config/width', np.asarray(self.width, dtype=np.float32))
+            serializer('config/n_residual', np.asarray(self.n_residual, dtype=np.int32))
+        except KeyError:
+            pass  # models saved before the configuration was stored
+
+    def observe(self, name, h):
+        for hook in self.hooks:
+            hook(name, h)
+        return h
+
+    def _observed_call(self, x, test):
+        o = self.observe
+        h = o('input', x)
+        for conv, bn in (('c1', 'b1'), ('c2', 'b2'), ('c3', 'b3')):
+            h = o(conv, self[conv](h))
+            h = o(conv + '/elu', F.elu(h))
+            h = o(bn, self[bn](h, test=test))
+        for name in self.residual_names:
+            h = o(name, self[name](h, test=test, observe=lambda n, v, name=name: o(name + '/' + n, v)))
+        for deconv, bn in (('d1', 'b4'), ('d2', 'b5')):
+            h = o(deconv, self[deconv](h))
+            h = o(deconv + '/elu', F.elu(h))
+            h = o(bn, self[bn](h, test=test))
+        y = o('d3', self.d3(h))
+        return o('output', (F.tanh(y)+1)*127.5)
 
     def __call__(self, x, test=False):
+        if self.hooks:
+            return self._observed_call(x, test)
         h = self.b1(F.elu(self.c1(x)), test=test)
         h = self.b2(F.elu(self.c2(h)), test=test)
         h = self.b3(F.elu(self.c3(h)), test=test)
-        h = self.r1(h, test=test)
-        h = self.r2(h, test=test)
-        h = self.r3(h, test=test)
-        h = self.r4(h, test=test)
-        h = self.r5(h, test=test)
+        for name in self.residual_names:
+            h = self[name](h, test=test)
         h = self.b4(F.elu(self.d1(h)), test=test)
         h = self.b5(F.elu(self.d2(h)), test=test)
         y = self.d3(h)
         return (F.tanh(y)+1)*127.5
 
-class VGG(chainer.Chain):
-    def __init__(self):
-        super(VGG, self).__init__(
-            conv1_1=L.Convolution2D(3, 64, 3, stride=1, pad=1),
-            conv1_2=L.Convolution2D(64, 64, 3, stride=1, pad=1),
+def saved_config(path):
+    """FastStyleNet arguments of the model saved at `path`; models without a
+    stored configuration have the default one."""
+    with np.load(path) as npz:
+        if 'config/width' not in npz.files:
+            return {}
+        return {'width': float(npz['config/width']), 'n_residual': int(npz['config/n_residual'])}
 
-            conv2_1=L.Convolution2D(64, 128, 3, stride=1, pad=1),
-            conv2_2=L.Convolution2D(128, 128, 3, stride=1, pad=1),
+def load_style_net(path):
+    """FastStyleNet with the configuration and parameters saved at `path`."""
+    model = FastStyleNet(**saved_config(path))
+    serializers.load_npz(path, model)
+    return model
 
-            conv3_1=L.Convolution2D(128, 256, 3, stride=1, pad=1),
-            conv3_2=L.Convolution2D(256, 256, 3, stride=1, pad=1),
-            conv3_3=L.Convolution2D(256, 256, 3, stride=1, pad=1),
+VGG_BLOCKS = [
+    (64, ('conv1_1', 'conv1_2')),
+    (128, ('conv2_1', 'conv2_2')),
+    (256, ('conv3_1', 'conv3_2', 'conv3_3')),
+    (512, ('conv4_1', 'conv4_2', 'conv4_3')),
+    (512, ('conv5_1', 'conv5_2', 'conv5_3')),
+]
 
-            conv4_1=L.Convolution2D(256, 512, 3, stride=1, pad=1),
-            conv4_2=L.Convolution2D(512, 512, 3, stride=1, pad=1),
-            conv4_3=L.Convolution2D(512, 512, 3, stride=1, pad=1),
+class VGG(chainer.Chain):
+    """VGG16 convolutions, returning the last activation of each block up to conv4_3.
 
-            conv5_1=L.Convolution2D(512, 512, 3, stride=1, pad=1),
-            conv5_2=L.Convolution2D(512, 512, 3, stride=1, pad=1),
-            conv5_3=L.Convolution2D(512, 512, 3, stride=1, pad=1)
-        )
+    Only the first `n_blocks` blocks are built (and loaded by load_npz); the
+    losses of train.py need at most four, conv5 is only kept by default so
+    that create_chainer_model.py converts the full set of weights.
+    """
+
+    def __init__(self, n_blocks=5):
+        links = {}
+        n_in = 3
+        for n_out, names in VGG_BLOCKS[:n_blocks]:
+            for name in names:
+                links[name] = L.Convolution2D(n_in, n_out, 3, stride=1, pad=1)
+                n_in = n_out
+        super(VGG, self).__init__(**links)
+        self.n_blocks = n_blocks
         self.train = False
         self.mean = np.asarray(120, dtype=np.float32)
 
@@ -93,11 +163,12 @@ class VGG(chainer.Chain):
         return np.rollaxis(image - self.mean, 2)
 
     def __call__(self, x):
-        y1 = F.relu(self.conv1_2(F.relu(self.conv1_1(x))))
-        h = F.max_pooling_2d(y1, 2, stride=2)
-        y2 = F.relu(self.conv2_2(F.relu(self.conv2_1(h))))
-        h = F.max_pooling_2d(y2, 2, stride=2)
-        y3 = F.relu(self.conv3_3(F.relu(self.conv3_2(F.relu(self.conv3_1(h))))))
-        h = F.max_pooling_2d(y3, 2, stride=2)
-        y4 = F.relu(self.conv4_3(F.relu(self.conv4_2(F.relu(self.conv4_1(h))))))
-        return [y1, y2, y3, y4]
+        ys = []
+        h = x
+        for i, (_, names) in enumerate(VGG_BLOCKS[:min(self.n_blocks, 4)]):
+            if i > 0:
+                h = F.max_pooling_2d(h, 2, stride=2)
+            for name in names:
+                h = F.relu(self[name](h))
+            ys.append(h)
+        return ys
@@ -0,0 +1,310 @@
+"""Chainer-free FastStyleNet inference.
+
+Activations are kept channel-last, (n, h, w, c), and weights in the layout
+written by ChainerDataReader.dump: (c_o, h, w, c_i) for convolutions and
+(c_i, h, w, c_o) for deconvolutions, whose chainer form is (c_i, c_o, h, w).
+"""
+from __future__ import print_function
+import os
+import time
+import argparse
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# chainer's BatchNormalization default; the exported `_stddev` is sqrt(avg_var) without it
+BN_EPS = 2e-5
+
+# Upper bound on the im2col buffer, convolutions are computed in row bands below it.
+IM2COL_BYTES = 64 * 1024 * 1024
+
+def pad_hw(x, pad):
+    if pad == 0:
+        return x
+    return np.pad(x, ((0, 0), (pad, pad), (pad, pad), (0, 0)), mode='constant')
+
+def im2col(x, kh, kw, stride):
+    """(n, h, w, c) -> strided (n, h_o, w_o, kh, kw, c) view of the receptive fields."""
+    n, h, w, c = x.shape
+    h_o = (h - kh) // stride + 1
+    w_o = (w - kw) // stride + 1
+    sn, sh, sw, sc = x.strides
+    return as_strided(x, (n, h_o, w_o, kh, kw, c), (sn, sh * stride, sw * stride, sh, sw, sc))
+
+def conv2d(x, W, b, stride=1, pad=0):
+    """Convolution as im2col + GEMM. x: (n, h, w, c_i), W: (c_o, kh, kw, c_i).
+
+    The GEMM always accumulates in float32, float16 inputs and weights are
+    only a storage format.
+    """
+    W = np.asarray(W, dtype=np.float32)
+    c_o, kh, kw, c_i = W.shape
+    cols = im2col(pad_hw(x, pad), kh, kw, stride)
+    n, h_o, w_o = cols.shape[:3]
+    Wm = W.reshape(c_o, -1).T
+    y = np.empty((n, h_o, w_o, c_o), dtype=np.float32)
+    band = max(1, IM2COL_BYTES // (w_o * kh * kw * c_i * 4))
+    for i in range(n):
+        for r in range(0, h_o, band):
+            patch = cols[i, r:r + band].reshape(-1, kh * kw * c_i)
+            y[i, r:r + band] = np.dot(patch, Wm).reshape(-1, w_o, c_o)
+    if b is not None:
+        y += b
+    return y
+
+def deconv2d(x, W, b, stride=1, pad=0):
+    """Transposed convolution as GEMM + col2im. x: (n, h, w, c_i), W: (c_i, kh, kw, c_o)."""
+    W = np.asarray(W, dtype=np.float32)
+    c_i, kh, kw, c_o = W.shape
+    n, h, w, _ = x.shape
+    cols = np.dot(x.reshape(-1, c_i), W.reshape(c_i, -1)).reshape(n, h, w, kh, kw, c_o)
+    y = np.zeros((n, (h - 1) * stride + kh, (w - 1) * stride + kw, c_o), dtype=np.float32)
+    for i in range(kh):
+        for j in range(kw):
+            y[:, i:i + stride * h:stride, j:j + stride * w:stride] += cols[:, :, :, i, j]
+    y = y[:, pad:y.shape[1] - pad, pad:y.shape[2] - pad]
+    if b is not None:
+        y += b
+    return y
+
+def subpixel_weight(W):
+    """4x4 stride-2 pad-1 deconvolution weight (c_i, 4, 4, c_o) -> 2x2 convolution weight (4 * c_o, 2, 2, c_i).
+
+    Output pixel (2m + s_r, 2n + s_c) of the deconvolution only sees the 2x2
+    input window starting at (m - 1 + s_r, n - 1 + s_c), through the taps
+    3 - s - 2t of window offset t. The four phases (s_r, s_c) are stacked
+    along the output channels, phase 2 * s_r + s_c first.
+    """
+    c_i, k, _, c_o = W.shape
+    assert k == 4, 'only 4x4 stride-2 pad-1 deconvolutions have this form'
+    Wsp = np.empty((4, c_o, 2, 2, c_i), dtype=W.dtype)
+    for sr in range(2):
+        for sc in range(2):
+            for tr in range(2):
+                for tc in range(2):
+                    Wsp[2 * sr + sc, :, tr, tc, :] = W[:, 3 - sr - 2 * tr, 3 - sc - 2 * tc, :].T
+    return Wsp.reshape(4 * c_o, 2, 2, c_i)
+
+def deconv_weight(Wsp):
+    """Inverse of subpixel_weight."""
+    c_o, c_i = Wsp.shape[0] // 4, Wsp.shape[3]
+    Wsp = Wsp.reshape(4, c_o, 2, 2, c_i)
+    W = np.empty((c_i, 4, 4, c_o), dtype=Wsp.dtype)
+    for sr in range(2):
+        for sc in range(2):
+            for tr in range(2):
+                for tc in range(2):
+                    W[:, 3 - sr - 2 * tr, 3 - sc - 2 * tc, :] = Wsp[2 * sr + sc, :, tr, tc, :].T
+    return W
+
+def subpixel_deconv2d(x, Wsp, b):
+    """4x4 stride-2 pad-1 deconvolution as one 2x2 convolution (pad 1) and a pixel shuffle.
+
+    Phase (s_r, s_c) of the output is the convolution output shifted by
+    (s_r, s_c), so no multiply-add touches an inserted zero.
+    """
+    c_o = Wsp.shape[0] // 4
+    n, h, w, _ = x.shape
+    z = conv2d(x, Wsp, None, 1, 1)
+    y = np.empty((n, 2 * h, 2 * w, c_o), dtype=np.float32)
+    for sr in range(2):
+        for sc in range(2):
+            phase = 2 * sr + sc
+            y[:, sr::2, sc::2] = z[:, sr:sr + h, sc:sc + w, phase * c_o:(phase + 1) * c_o]
+    if b is not None:
+        y += b
+    return y
+
+def subpixel_params(params, subpixel=True):
+    """Rewrites the 4x4 deconvolutions of `params` as `<layer>_sp_W` (or back, with subpixel=False)."""
+    params = dict(params)
+    for layer in ('d1', 'd2'):
+        if subpixel and layer + '_W' in params and params[layer + '_W'].shape[1] == 4:
+            params[layer + '_sp_W'] = subpixel_weight(params.pop(layer + '_W'))
+        elif not subpixel and layer + '_sp_W' in params:
+            params[layer + '_W'] = deconv_weight(params.pop(layer + '_sp_W'))
+    return params
+
+def elu(x):
+    return np.where(x > 0, x, np.expm1(np.minimum(x, 0)))
+
+def relu(x):
+    return np.maximum(x, 0)
+
+def batch_norm(x, scale, shift):
+    return x * scale + shift
+
+def bn_params(params, name):
+    # test-mode BatchNormalization as a per-channel scale and shift
+    std = np.sqrt(params[name + '_stddev'] ** 2 + BN_EPS)
+    scale = params[name + '_gamma'] / std
+    return scale.astype(np.float32), (params[name + '_beta'] - params[name + '_mean'] * scale).astype(np.float32)
+
+def count_residual_blocks(names):
+    n = 0
+    while 'r{}_c1_W'.format(n + 1) in names:
+        n += 1
+    return n
+
+def infer_shapes(sizes):
+    """Shapes of the exported tensors, given the number of float32 values of each."""
+    def kernel(name, c_a, c_b):
+        k = int(round(np.sqrt(sizes[name] // (c_a * c_b))))
+        return (c_a, k, k, c_b)
+
+    n_residual = count_residual_blocks(sizes)
+    channels = dict((layer, sizes[layer + '_b']) for layer in ('c1', 'c2', 'c3', 'd1', 'd2', 'd3'))
+    shapes = dict((name, (size,)) for name, size in sizes.items())
+    shapes['c1_W'] = kernel('c1_W', channels['c1'], 3)
+    shapes['c2_W'] = kernel('c2_W', channels['c2'], channels['c1'])
+    shapes['c3_W'] = kernel('c3_W', channels['c3'], channels['c2'])
+    for i in range(1, n_residual + 1):
+        for c in ('c1', 'c2'):
+            name = 'r{}_{}_W'.format(i, c)
+            shapes[name] = kernel(name, channels['c3'], channels['c3'])
+    for layer, c_in in (('d1', channels['c3']), ('d2', channels['d1'])):
+        if layer + '_sp_W' in sizes:
+            shapes[layer + '_sp_W'] = kernel(layer + '_sp_W', 4 * channels[layer], c_in)
+        else:
+            shapes[layer + '_W'] = kernel(layer + '_W', c_in, channels[layer])
+    shapes['d3_W'] = kernel('d3_W', channels['d2'], channels['d3'])
+    return shapes
+
+def load_dat_dir(path, dtype=np.float32):
+    # .dat files have no header, `dtype` has to match the one they were exported with
+    raw = {}
+    for fn in os.listdir(path):
+        name, ext = os.path.splitext(fn)
+        if ext == '.dat':
+            raw[name] = np.fromfile(os.path.join(path, fn), dtype=dtype)
+    shapes = infer_shapes(dict((name, data.size) for name, data in raw.items()))
+    return dict((name, data.reshape(shapes[name])) for name, data in raw.items())
+
+def load_params(path, dat_dtype=np.float32):
+    """Parameters from a folder of .dat files or from a weight bundle (memory mapped)."""
+    if os.path.isdir(path):
+        return load_dat_dir(path, dat_dtype)
+    from bundle import Bundle
+    return dict(Bundle(path).items())
+
+class NumpyStyleNet(object):
+    """FastStyleNet forward pass (test mode) on exported parameters.
+
+    Input and output are (n, h, w, 3) float32 RGB in [0, 255]. An optional
+    `hook(name, activation)` is called after every layer, using the link
+    names of FastStyleNet (the `bN` entries include the preceding ELU).
+
+    With `dtype=np.float16` weights and activations are rounded to half
+    precision and activations are stored that way between layers, while the
+    GEMMs accumulate in float32, the way the device runs its half-precision
+    textures. The rounded weights are kept as float32 GEMM operands.
+
+    d1 and d2 run as sub-pixel convolutions when the parameters carry
+    `<layer>_sp_W` (convert_chainer.py --subpixel); `subpixel=True` or False
+    converts the parameters to that form or back.
+    """
+
+    def __init__(self, params, dtype=np.float32, subpixel=None):
+        if subpixel is not None:
+            params = subpixel_params(params, subpixel)
+        self.dtype = np.dtype(dtype)
+        self.n_residual = count_residual_blocks(params)
+        self.bn = dict((name, tuple(p.astype(self.dtype) for p in bn_params(params, name)))
+                       for name in [n[:-len('_mean')] for n in params if n.endswith('_mean')])
+        self.params = dict((name, self.stored(name, p)) for name, p in params.items())
+
+    def stored(self, name, p):
+        # weights are rounded to the storage precision once and kept as the
+        # float32 GEMM operands, so forwards do not convert them layer by layer
+        if p.dtype != self.dtype:
+            p = p.astype(self.dtype)
+        if name.endswith('_W') and p.dtype != np.float32:
+            p = p.astype(np.float32)
+        return p
+
+    @classmethod
+    def from_dat_dir(cls, path, dtype=np.float32):
+        return cls(load_dat_dir(path), dtype)
+
+    @classmethod
+    def load(cls, path, dtype=np.float32, dat_dtype=np.float32, subpixel=None):
+        return cls(load_params(path, dat_dtype), dtype, subpixel)
+
+    def store(self, h):
+        return h.astype(self.dtype, copy=False)
+
+    def conv(self, name, x, stride, pad):
+        return self.store(conv2d(x, self.params[name + '_W'], self.params[name + '_b'], stride, pad))
+
+    def deconv(self, name, x, stride, pad):
+        if name + '_sp_W' in self.params:
+            return self.store(subpixel_deconv2d(x, self.params[name + '_sp_W'], self.params[name + '_b']))
+        return self.store(deconv2d(x, self.params[name + '_W'], self.params[name + '_b'], stride, pad))
+
+    def residual(self, name, x):
+        h = relu(batch_norm(self.conv(name + '_c1', x, 1, 1), *self.bn[name + '_b1']))
+        h = batch_norm(self.conv(name + '_c2', h, 1, 1), *self.bn[name + '_b2'])
+        return h + x
+
+    def observe(self, name, h, hook):
+        """Called with the output of every layer; subclasses may return a replacement."""
+        if hook is not None:
+            hook(name, h)
+        return h
+
+    def __call__(self, x, hook=None):
+        h = self.store(np.asarray(x, dtype=np.float32))
+        for conv, bn, stride, pad in (('c1', 'b1', 1, 4), ('c2', 'b2', 2, 1), ('c3', 'b3', 2, 1)):
+            h = self.observe(conv, self.conv(conv, h, stride, pad), hook)
+            h = self.observe(bn, batch_norm(elu(h), *self.bn[bn]), hook)
+        for i in range(1, self.n_residual + 1):
+            name = 'r{}'.format(i)
+            h = self.observe(name, self.residual(name, h), hook)
+        for deconv, bn in (('d1', 'b4'), ('d2', 'b5')):
+            h = self.observe(deconv, self.deconv(deconv, h, 2, 1), hook)
+            h = self.observe(bn, batch_norm(elu(h), *self.bn[bn]), hook)
+        y = self.observe('d3', self.deconv('d3', h, 1, 4), hook)
+        return (np.tanh(y.astype(np.float32)) + 1) * 127.5
+
+def main():
+    from PIL import Image
+
+    parser = argparse.ArgumentParser(description='Real-time style transfer with the NumPy engine')
+    parser.add_argument('input')
+    parser.add_argument('--model_data', '-d', required=True, type=str,
+                        help='directory of .dat files or weight bundle written by convert_chainer.py')
+    parser.add_argument('--half', action='store_true',
+                        help='store weights and activations in float16 (GEMMs accumulate in float32)')
+    parser.add_argument('--dat_dtype', default='float32', choices=('float32', 'float16'),
+                        help='dtype the .dat files were exported with')
+    parser.add_argument('--subpixel', action='store_true',
+                        help='run d1 and d2 as sub-pixel convolutions')
+    parser.add_argument('--fft', action='store_true',
+                        help='run the 9x9 layers c1 and d3 as FFT convolutions (faster on large images)')
+    parser.add_argument('--fused', action='store_true',
+                        help='run the residual blocks through the fused, cache-blocked executor')
+    parser.add_argument('--out', '-o', default='out.jpg', type=str)
+    args = parser.parse_args()
+
+    start = time.time()
+    dtype = np.float16 if args.half else np.float32
+    if args.fft and args.fused:
+        parser.error('--fft and --fused are separate engines')
+    if args.fused:
+        from fused_residual import FusedStyleNet
+        model = FusedStyleNet(load_params(args.model_data, args.dat_dtype), dtype, subpixel=args.subpixel or None)
+    elif args.fft:
+        from fft_conv import FFTStyleNet
+        model = FFTStyleNet(load_params(args.model_data, args.dat_dtype), dtype, subpixel=args.subpixel or None)
+    else:
+        model = NumpyStyleNet.load(args.model_data, dtype, args.dat_dtype, subpixel=args.subpixel or None)
+    print(time.time() - start, 'sec to load')
+
+    start = time.time()
+    image = np.asarray(Image.open(args.input).convert('RGB'), dtype=np.float32)
+    result = model(image[np.newaxis])[0]
+    print(time.time() - start, 'sec')
+    Image.fromarray(np.uint8(result)).save(args.out)
+
+if __name__ == '__main__':
+    main()
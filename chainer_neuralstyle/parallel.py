@@ -0,0 +1,173 @@
+"""Data-parallel training across local processes with a shared-memory gradient all-reduce.
+
+The parent creates a SharedAllreduce sized for the model and launches one
+process per rank; every rank holds a full model replica, computes the
+gradients of its own batch, and GradientSync averages them in place before
+the optimizer update. All ranks start from rank 0's parameters and apply the
+same averaged gradients with the same optimizer, so the replicas stay
+identical. The BatchNormalization running statistics are not parameters;
+each rank updates them from its own batches, so GradientSync averages them
+through a second, small SharedAllreduce after every update.
+"""
+import time
+import multiprocessing
+
+import numpy as np
+
+class Barrier(object):
+    """Process barrier (multiprocessing.Barrier is Python 3 only)."""
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.count = multiprocessing.RawValue('i', 0)
+        self.generation = multiprocessing.RawValue('i', 0)
+        self.cond = multiprocessing.Condition()
+
+    def wait(self):
+        with self.cond:
+            generation = self.generation.value
+            self.count.value += 1
+            if self.count.value == self.parties:
+                self.count.value = 0
+                self.generation.value += 1
+                self.cond.notify_all()
+            else:
+                while generation == self.generation.value:
+                    self.cond.wait()
+
+class SharedAllreduce(object):
+    """Averages float32 vectors of `size` elements across `n_workers` processes.
+
+    Each rank writes its vector to its own slot, then reduces a 1/n chunk
+    of the slots into the shared result (a reduce-scatter), and finally
+    copies the whole result back. The summation order is fixed, so the
+    result does not depend on timing.
+    """
+
+    def __init__(self, size, n_workers):
+        self.size = size
+        self.n_workers = n_workers
+        self.slots = multiprocessing.RawArray('f', size * n_workers)
+        self.result = multiprocessing.RawArray('f', size)
+        self.barrier = Barrier(n_workers)
+
+    def attach(self, rank):
+        """Called once in each worker process."""
+        self.rank = rank
+        self.slot_array = np.frombuffer(self.slots, np.float32).reshape(self.n_workers, self.size)
+        self.result_array = np.frombuffer(self.result, np.float32)
+        self.chunk = slice(self.size * rank // self.n_workers, self.size * (rank + 1) // self.n_workers)
+
+    def mean(self, vector):
+        self.slot_array[self.rank] = vector
+        self.barrier.wait()
+        chunk = self.result_array[self.chunk]
+        np.sum(self.slot_array[:, self.chunk], axis=0, out=chunk)
+        chunk /= self.n_workers
+        self.barrier.wait()
+        vector[...] = self.result_array
+
+    def broadcast(self, vector, root=0):
+        # the first barrier keeps the root from overwriting a result other ranks are still copying
+        self.barrier.wait()
+        if self.rank == root:
+            self.result_array[...] = vector
+        self.barrier.wait()
+        vector[...] = self.result_array
+
+def parameter_count(link):
+    return sum(p.data.size for _, p in link.namedparams())
+
+def _bn_links(link):
+    return [l for _, l in sorted(link.namedlinks(), key=lambda item: item[0]) if hasattr(l, 'avg_var')]
+
+def running_stats_count(link):
+    """Number of BatchNormalization running-statistics values (avg_mean and avg_var) of `link`."""
+    return sum(l.avg_mean.size + l.avg_var.size for l in _bn_links(link))
+
+class GradientSync(object):
+    """Flattens the parameters of `link` (in name order) for a SharedAllreduce.
+
+    `stats_reducer`, sized by running_stats_count, averages the running
+    statistics of its BatchNormalization links in sync_stats().
+    """
+
+    def __init__(self, link, reducer, stats_reducer=None):
+        self.params = [p for _, p in sorted(link.namedparams(), key=lambda item: item[0])]
+        self.reducer = reducer
+        self.buffer = np.empty(reducer.size, dtype=np.float32)
+        self.bn_links = _bn_links(link)
+        self.stats_reducer = stats_reducer
+        if stats_reducer is not None:
+            self.stats_buffer = np.empty(stats_reducer.size, dtype=np.float32)
+
+    @staticmethod
+    def _gather(arrays, buffer):
+        offset = 0
+        for a in arrays:
+            buffer[offset:offset + a.size] = a.ravel()
+            offset += a.size
+
+    @staticmethod
+    def _scatter(arrays, buffer):
+        offset = 0
+        for a in arrays:
+            a[...] = buffer[offset:offset + a.size].reshape(a.shape)
+            offset += a.size
+
+    def broadcast_params(self, root=0):
+        params = [p.data for p in self.params]
+        self._gather(params, self.buffer)
+        self.reducer.broadcast(self.buffer, root)
+        self._scatter(params, self.buffer)
+        if self.stats_reducer is not None:
+            stats = self._stats()
+            self._gather(stats, self.stats_buffer)
+            self.stats_reducer.broadcast(self.stats_buffer, root)
+            self._scatter(stats, self.stats_buffer)
+
+    def allreduce(self):
+        grads = [p.grad for p in self.params]
+        self._gather(grads, self.buffer)
+        self.reducer.mean(self.buffer)
+        self._scatter(grads, self.buffer)
+
+    def _stats(self):
+        stats = []
+        for l in self.bn_links:
+            stats += [l.avg_mean, l.avg_var]
+        return stats
+
+    def sync_stats(self):
+        """Averages the running statistics; a collective call, like allreduce."""
+        stats = self._stats()
+        self._gather(stats, self.stats_buffer)
+        self.stats_reducer.mean(self.stats_buffer)
+        self._scatter(stats, self.stats_buffer)
+
+def shard(batch_indices, rank, n_workers):
+    """Batches of one rank: step k of rank r is global batch k * n_workers + r."""
+    n_steps = len(batch_indices) // n_workers
+    return batch_indices[rank:n_steps * n_workers:n_workers]
+
+def launch(target, n_workers, *shared):
+    """Runs target(rank, n_workers, *shared) in one process per rank.
+
+    If a rank fails the others would block in the all-reduce, so they are
+    terminated.
+    """
+    procs = [multiprocessing.Process(target=target, args=(rank, n_workers) + shared) for rank in range(n_workers)]
+    for p in procs:
+        p.start()
+    while any(p.is_alive() for p in procs):
+        if any(p.exitcode not in (None, 0) for p in procs):
+            for p in procs:
+                if p.is_alive():
+                    p.terminate()
+            break
+        time.sleep(0.5)
+    for p in procs:
+        p.join()
+    failed = [rank for rank, p in enumerate(procs) if p.exitcode != 0]
+    if failed:
+        raise SystemExit('training rank(s) {} failed'.format(', '.join(map(str, failed))))
@@ -0,0 +1,99 @@
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+_END = object()
+
+class _Failure(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+def prefetch(iterable, depth=2):
+    """Iterate over `iterable` on a background thread, keeping up to `depth` items ready."""
+    q = queue.Queue(depth)
+
+    def fill():
+        try:
+            for item in iterable:
+                q.put(item)
+        except Exception as e:
+            q.put(_Failure(e))
+        q.put(_END)
+
+    t = threading.Thread(target=fill)
+    t.daemon = True
+    t.start()
+    while True:
+        item = q.get()
+        if item is _END:
+            break
+        if isinstance(item, _Failure):
+            raise item.exc
+        yield item
+    t.join()
+
+class Sink(object):
+    """Applies `func` to each item put into it on a background thread."""
+
+    def __init__(self, func, depth=2):
+        self.func = func
+        self.queue = queue.Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._drain)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _drain(self):
+        while True:
+            item = self.queue.get()
+            if item is _END:
+                break
+            if self.error is None:
+                try:
+                    self.func(item)
+                except Exception as e:
+                    self.error = e
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def close(self):
+        self.queue.put(_END)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class StageStats(object):
+    """Collects per-item service times of one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.times = []
+
+    def timed(self, func):
+        def wrapper(*args):
+            start = time.time()
+            result = func(*args)
+            self.times.append(time.time() - start)
+            return result
+        return wrapper
+
+    def summary(self):
+        if not self.times:
+            return {'count': 0}
+        t = np.asarray(self.times) * 1000
+        return {'count': len(t), 'mean_ms': float(t.mean()), 'p50_ms': float(np.percentile(t, 50)),
+                'p95_ms': float(np.percentile(t, 95)), 'max_ms': float(t.max())}
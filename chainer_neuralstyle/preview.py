@@ -0,0 +1,222 @@
+"""Low-latency previews: the network at a reduced resolution, upsampled guided by the full-resolution input.
+
+The stylized low-resolution output is brought back to full size with the
+fast guided filter (He and Sun, 2015): per pixel, the output is modelled as
+a linear function a * I + b of the luminance I of the input; a and b are
+fitted over small windows at low resolution, smoothed, upsampled
+bilinearly and applied to the full-resolution luminance, so edges of the
+input stay sharp in the preview. The network costs roughly 1 / factor^2 of
+a full forward; the filter is a handful of box filters.
+
+    python preview.py sample_images/tubingen.jpg -m models/composition.model --factors 2 4 8
+
+prints the latency of every factor and how close the preview comes to the
+full-resolution output: PSNR at the preview's own scale (both images box
+downsampled by the factor) and the SSIM of the luminance, next to plain
+bilinear upsampling and a flat image of the output's mean color. A preview
+that does not beat the flat image on a metric carries no information on it.
+"""
+from __future__ import print_function
+import time
+import argparse
+import threading
+
+import numpy as np
+from PIL import Image
+
+from tiling import ALIGN
+from compare_precision import psnr
+
+def luminance(image):
+    """(3, h, w) RGB in [0, 255] -> (h, w) luminance in [0, 1]."""
+    return np.tensordot(np.float32([0.299, 0.587, 0.114]) / 255, image, axes=1)
+
+def resize(x, size):
+    """Bilinear resize of the last two axes of `x` to `size` = (h, w)."""
+    h, w = size
+    planes = np.asarray(x, dtype=np.float32).reshape((-1,) + x.shape[-2:])
+    out = [np.asarray(Image.fromarray(p).resize((w, h), Image.BILINEAR)) for p in planes]
+    return np.stack(out).reshape(x.shape[:-2] + (h, w))
+
+def box_filter(x, r):
+    """Mean over the (2r + 1)^2 window around every pixel of the last two axes, clipped at the borders."""
+    h, w = x.shape[-2:]
+    s = np.zeros(x.shape[:-2] + (h + 1, w + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(x, axis=-2), axis=-1, out=s[..., 1:, 1:])
+    y0, y1 = np.clip(np.arange(h) - r, 0, h), np.clip(np.arange(h) + r + 1, 0, h)
+    x0, x1 = np.clip(np.arange(w) - r, 0, w), np.clip(np.arange(w) + r + 1, 0, w)
+    total = (s[..., y1[:, None], x1] - s[..., y0[:, None], x1]
+             - s[..., y1[:, None], x0] + s[..., y0[:, None], x0])
+    return (total / ((y1 - y0)[:, None] * (x1 - x0))).astype(np.float32)
+
+def guided_upsample(low, guide_low, guide, radius=2, eps=1e-2):
+    """Fast guided filter upsampling.
+
+    `low` is the (c, h, w) stylized output, `guide_low` and `guide` the
+    (h, w) and (H, W) luminance of its input and of the full-resolution
+    image; returns the (c, H, W) upsampled output.
+    """
+    mean_i = box_filter(guide_low, radius)
+    mean_p = box_filter(low, radius)
+    cov_ip = box_filter(low * guide_low, radius) - mean_p * mean_i
+    var_i = box_filter(guide_low * guide_low, radius) - mean_i * mean_i
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    size = guide.shape
+    return resize(box_filter(a, radius), size) * guide + resize(box_filter(b, radius), size)
+
+def low_size(shape, factor):
+    """Input size at `factor` times lower resolution, on the network's stride grid."""
+    h, w = shape
+    return (max(int(round(h / float(factor))) // ALIGN * ALIGN, ALIGN),
+            max(int(round(w / float(factor))) // ALIGN * ALIGN, ALIGN))
+
+def preview(forward, image, factor=4, radius=2, eps=1e-2, guided=True):
+    """Stylizes the (3, H, W) float32 `image` at 1 / `factor` resolution and
+    returns the result upsampled to full size, which like the network's own
+    output is cropped to a multiple of tiling.ALIGN.
+
+    `forward` maps a (1, 3, h, w) float32 array to its (1, 3, h, w) stylized
+    output, as for tiling.tiled_stylize.
+    """
+    if factor <= 1:
+        return forward(image[np.newaxis])[0]
+    image = image[:, :image.shape[1] // ALIGN * ALIGN, :image.shape[2] // ALIGN * ALIGN]
+    size = image.shape[1:]
+    small = resize(image, low_size(size, factor))
+    y = forward(small[np.newaxis])[0]
+    if not guided:
+        return resize(y, size)
+    return guided_upsample(y, luminance(small), luminance(image), radius, eps)
+
+def refinement_factors(factor):
+    """Factors of a progressive refinement after a preview at `factor`, halving down to full resolution."""
+    factors = []
+    while factor > 2:
+        factor /= 2.
+        factors.append(factor)
+    return factors + [1]
+
+class Refinement(object):
+    """Progressive refinement in the background.
+
+    Runs `preview` at every factor of `factors` in turn (1 is the plain
+    full-resolution forward) on a daemon thread and passes each result to
+    `callback(factor, result)`. `cancel()` stops after the current step, so
+    a new image can be started without waiting for the old one.
+    """
+
+    def __init__(self, forward, image, factors=(2, 1), callback=None, **kwargs):
+        self.results = {}
+        self.error = None
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(forward, image, factors, callback, kwargs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, forward, image, factors, callback, kwargs):
+        try:
+            for factor in factors:
+                if self._cancelled.is_set():
+                    return
+                result = preview(forward, image, factor, **kwargs)
+                self.results[factor] = result
+                if callback is not None:
+                    callback(factor, result)
+        except Exception as e:
+            self.error = e
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def join(self, timeout=None):
+        """Waits for the refinement, raising any error of the background thread."""
+        self._thread.join(timeout)
+        if self.error is not None:
+            raise self.error
+
+def image_psnr(reference, actual):
+    """PSNR in dB of the uint8 images of two outputs."""
+    return psnr(np.uint8(np.clip(reference, 0, 255)), np.uint8(np.clip(actual, 0, 255)), 255.)
+
+def downsample(x, factor):
+    """Box (area) downsampling of a (c, h, w) image by `factor`."""
+    h, w = x.shape[1:]
+    size = (max(int(round(w / float(factor))), 1), max(int(round(h / float(factor))), 1))
+    return np.stack([np.asarray(Image.fromarray(np.float32(p)).resize(size, Image.BOX)) for p in x])
+
+def scaled_psnr(reference, actual, factor):
+    """PSNR of two outputs compared at 1 / `factor` resolution, where the preview was computed."""
+    return image_psnr(downsample(reference, factor), downsample(actual, factor))
+
+def ssim(reference, actual, radius=3):
+    """Mean SSIM of the luminance of two (3, h, w) outputs over (2 * radius + 1)^2 box windows."""
+    a, b = luminance(reference), luminance(actual)
+    mean_a, mean_b = box_filter(a, radius), box_filter(b, radius)
+    var_a = box_filter(a * a, radius) - mean_a * mean_a
+    var_b = box_filter(b * b, radius) - mean_b * mean_b
+    cov = box_filter(a * b, radius) - mean_a * mean_b
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+    s = (2 * mean_a * mean_b + c1) * (2 * cov + c2) / ((mean_a ** 2 + mean_b ** 2 + c1) * (var_a + var_b + c2))
+    return float(s.mean())
+
+def flat(reference):
+    """The baseline preview: every pixel the mean color of the output."""
+    return np.ones_like(reference) * reference.mean(axis=(1, 2), keepdims=True)
+
+def best_time(f, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        y = f()
+        times.append(time.time() - start)
+    return y, min(times)
+
+def chainer_forward(model_path, gpu, test):
+    from inference import load_model, stylize
+    model = load_model(model_path, gpu)
+    return lambda x: stylize(model, x, test)
+
+def numpy_forward(model_data):
+    from numpy_engine import NumpyStyleNet, load_params
+    model = NumpyStyleNet(load_params(model_data))
+    return lambda x: model(x.transpose(0, 2, 3, 1)).transpose(0, 3, 1, 2)
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency and quality of previews at reduced resolution')
+    parser.add_argument('input', help='input image')
+    parser.add_argument('--model', '-m', default='models/style.model', type=str)
+    parser.add_argument('--model_data', '-d', default=None, type=str,
+                        help='.dat folder or weight bundle, run with the NumPy engine instead of the model')
+    parser.add_argument('--gpu', '-g', default=-1, type=int,
+                        help='GPU ID (negative value indicates CPU)')
+    parser.add_argument('--bn', default='batch', choices=('batch', 'running'),
+                        help='BatchNormalization statistics, as for generate.py (the NumPy engine only has running)')
+    parser.add_argument('--factors', nargs='+', type=float, default=[2, 3, 4, 6, 8])
+    parser.add_argument('--radius', default=2, type=int, help='guided filter radius at low resolution')
+    parser.add_argument('--eps', default=1e-2, type=float, help='guided filter regularization')
+    parser.add_argument('--repeat', default=3, type=int)
+    args = parser.parse_args()
+    if args.model_data and args.bn != 'running':
+        parser.error('the NumPy engine only runs with the running statistics, pass --bn running')
+
+    forward = numpy_forward(args.model_data) if args.model_data else chainer_forward(args.model, args.gpu, args.bn == 'running')
+    image = np.asarray(Image.open(args.input).convert('RGB'), dtype=np.float32).transpose(2, 0, 1)
+    forward(image[np.newaxis, :, :ALIGN * 4, :ALIGN * 4])  # warm up
+    reference, t_full = best_time(lambda: forward(image[np.newaxis])[0], args.repeat)
+    print('{}x{} full resolution: {:.1f} ms'.format(image.shape[2], image.shape[1], t_full * 1000))
+    baseline = flat(reference)
+    row = '{:>7} {:>10} {:>10} {:>8}  {:>8} {:>8} {:>8}  {:>8} {:>8} {:>8}'
+    print(row.format('', '', '', '', '', 'PSNR dB', '', '', 'SSIM', ''))
+    print(row.format('factor', 'size', 'ms', 'speedup', 'bilinear', 'guided', 'flat', 'bilinear', 'guided', 'flat'))
+    for factor in args.factors:
+        h, w = low_size(image.shape[1:], factor)
+        bilinear = preview(forward, image, factor, guided=False)
+        guided, t = best_time(lambda: preview(forward, image, factor, args.radius, args.eps), args.repeat)
+        candidates = (bilinear, guided, baseline)
+        print(row.format('{:g}'.format(factor), '{}x{}'.format(w, h), '{:.1f}'.format(t * 1000), '{:.1f}x'.format(t_full / t),
+                         *(['{:.2f}'.format(scaled_psnr(reference, y, factor)) for y in candidates] +
+                           ['{:.3f}'.format(ssim(reference, y)) for y in candidates])))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""int8 weight quantization for exported FastStyleNet parameters.
+
+Every convolution/deconvolution weight is quantized symmetrically per output
+channel (axis 0 of the (c_o, h, w, c_i) convolution layout, axis 3 of the
+(c_i, h, w, c_o) deconvolution layout; the sub-pixel `d*_sp_W` are
+convolutions). The bundle stores the int8 tensor under the original name
+next to `<name>__qscale` and `<name>__qzero_point`, suffixes no exported
+tensor ends with (a folded export has its own `b3_scale`).
+Activation ranges collected on calibration images are stored as
+`act_<layer>__qscale` / `act_<layer>__qzero_point` (asymmetric uint8) for the
+tensors an int8 pipeline materializes between convolutions: the outputs of
+the normalization layers `bN` and of the residual blocks `rN`. The raw
+convolution outputs stay int32 accumulators and are not quantized.
+"""
+from __future__ import print_function
+import os
+import glob
+import time
+import argparse
+
+import numpy as np
+
+from bundle import Bundle, write_bundle
+from numpy_engine import NumpyStyleNet, load_params
+from compare_precision import compare, load_image, report
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+SCALE, ZERO_POINT = '__qscale', '__qzero_point'
+
+def channel_axis(name):
+    # deconvolutions (d1, d2, d3 and their folded `_shift_W`) are (c_i, h, w, c_o)
+    return 3 if name.startswith('d') and not name.endswith('_sp_W') else 0
+
+def quantize_weight(W, axis):
+    reduce_axes = tuple(a for a in range(W.ndim) if a != axis)
+    scale = np.abs(W).max(axis=reduce_axes) / 127.
+    scale[scale == 0] = 1.
+    shape = [1] * W.ndim
+    shape[axis] = -1
+    q = np.clip(np.round(W / scale.reshape(shape)), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32), np.zeros(scale.shape, dtype=np.int8)
+
+def dequantize_weight(q, scale, zero_point, axis):
+    shape = [1] * q.ndim
+    shape[axis] = -1
+    return (q.astype(np.float32) - zero_point.reshape(shape)) * scale.reshape(shape)
+
+def is_materialized(layer):
+    return layer[0] in 'br'
+
+def activation_qparams(lo, hi):
+    lo, hi = min(lo, 0.), max(hi, 0.)
+    scale = (hi - lo) / 255. or 1.
+    return np.float32(scale), np.int32(np.round(-lo / scale))
+
+def calibrate(model, images):
+    """Per-layer (min, max) of the outputs of `model` over `images`."""
+    ranges = {}
+
+    def record(name, h):
+        lo, hi = float(h.min()), float(h.max())
+        if name in ranges:
+            lo, hi = min(lo, ranges[name][0]), max(hi, ranges[name][1])
+        ranges[name] = (lo, hi)
+
+    for x in images:
+        model(x, hook=record)
+    return ranges
+
+def quantize(params, ranges, keep_float=()):
+    tensors = []
+    for name in sorted(params):
+        data = params[name]
+        layer = name[:-len('_W')]
+        if data.ndim == 4 and layer not in keep_float:
+            q, scale, zero_point = quantize_weight(data, channel_axis(name))
+            tensors += [(name, q), (name + SCALE, scale), (name + ZERO_POINT, zero_point)]
+        else:
+            tensors.append((name, np.asarray(data, dtype=np.float32)))
+    for layer in sorted(l for l in ranges if is_materialized(l)):
+        scale, zero_point = activation_qparams(*ranges[layer])
+        tensors += [('act_' + layer + SCALE, np.array([scale])),
+                    ('act_' + layer + ZERO_POINT, np.array([zero_point]))]
+    return tensors
+
+def dequantize(bundle):
+    params = {}
+    for name in bundle:
+        if name.startswith('act_') or name.endswith(SCALE) or name.endswith(ZERO_POINT):
+            continue
+        data = bundle[name]
+        if data.dtype == np.int8:
+            data = dequantize_weight(data, bundle[name + SCALE], bundle[name + ZERO_POINT], channel_axis(name))
+        params[name] = data
+    return params
+
+class QuantizedStyleNet(NumpyStyleNet):
+    """NumpyStyleNet on dequantized int8 weights.
+
+    With `quantize_activations` the calibrated layer outputs are also
+    rounded to their uint8 grid, to see the error of an all-int8 pipeline.
+    """
+
+    def __init__(self, bundle, quantize_activations=False):
+        super(QuantizedStyleNet, self).__init__(dequantize(bundle))
+        self.act = {}
+        if quantize_activations:
+            for name in bundle:
+                if name.startswith('act_') and name.endswith(SCALE):
+                    layer = name[len('act_'):-len(SCALE)]
+                    self.act[layer] = (float(bundle[name][0]), int(bundle['act_' + layer + ZERO_POINT][0]))
+
+    @classmethod
+    def load(cls, path, quantize_activations=False):
+        return cls(Bundle(path), quantize_activations)
+
+    def observe(self, name, h, hook):
+        if name in self.act:
+            scale, zero_point = self.act[name]
+            q = np.clip(np.round(h / scale) + zero_point, 0, 255)
+            h = ((q - zero_point) * scale).astype(h.dtype)
+        return super(QuantizedStyleNet, self).observe(name, h, hook)
+
+def list_images(entries):
+    paths = []
+    for entry in entries:
+        if os.path.isdir(entry):
+            paths += [os.path.join(entry, fn) for fn in sorted(os.listdir(entry))
+                      if os.path.splitext(fn)[1].lower() in IMAGE_EXTENSIONS]
+        else:
+            paths += sorted(glob.glob(entry))
+    return paths
+
+def file_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path))
+    return os.path.getsize(path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Quantize exported FastStyleNet weights to int8')
+    parser.add_argument('model_data', help='directory of .dat files or weight bundle (float32)')
+    parser.add_argument('out', help='quantized weight bundle to write')
+    parser.add_argument('--calibration', '-c', nargs='+', default=['sample_images'],
+                        help='calibration images (files, directories or glob patterns)')
+    parser.add_argument('--eval', '-e', nargs='*', default=None,
+                        help='images to measure the error on (default: the calibration images)')
+    parser.add_argument('--max_size', default=512, type=int, help='downscale images to this longest side')
+    parser.add_argument('--keep_float', nargs='*', default=[],
+                        help='layers whose weights stay float32, e.g. c1 d3')
+    args = parser.parse_args()
+
+    params = load_params(args.model_data)
+    reference = NumpyStyleNet(params)
+    calibration = [load_image(p, args.max_size) for p in list_images(args.calibration)]
+    ranges = calibrate(reference, calibration)
+    write_bundle(args.out, quantize(params, ranges, args.keep_float))
+
+    start = time.time()
+    weights_only = QuantizedStyleNet.load(args.out)
+    load_time = time.time() - start
+    all_int8 = QuantizedStyleNet.load(args.out, quantize_activations=True)
+    print('size: {:.2f} MB float32 -> {:.2f} MB int8, load + dequantize {:.3f} sec'.format(
+        file_size(args.model_data) / 1024.**2, file_size(args.out) / 1024.**2, load_time))
+
+    images = calibration if args.eval is None else [load_image(p, args.max_size) for p in list_images(args.eval)]
+    for title, model in (('int8 weights', weights_only), ('int8 weights and activations', all_int8)):
+        print('\n' + title)
+        report(dict((i, compare(reference, model, x)) for i, x in enumerate(images)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Registry of style models: discovery, lazy loading and an LRU bounded by memory.
+
+    registry = ModelRegistry('models', max_bytes=512 * 2 ** 20)
+    registry.prewarm(['composition', 'seurat'])
+    forward = registry.get('seurat')   # (n, h, w, 3) float32 -> (n, h, w, 3) float32
+
+Styles are named after their file (`models/seurat.model` -> 'seurat'). With
+the numpy engine they are weight bundles or folders of .dat files.
+"""
+from __future__ import print_function
+import os
+import time
+import threading
+import collections
+
+EXTENSIONS = {'chainer': ('.model',), 'numpy': ('.bundle',)}
+
+# Unknown names rescan the directory at most this often (seconds), so that
+# requests for made-up styles cannot keep the server listing directories.
+RESCAN_INTERVAL = 5.0
+
+def chainer_model_bytes(model):
+    import chainer.links as L
+    n = sum(p.data.nbytes for p in model.params())
+    for link in model.links():
+        if isinstance(link, L.BatchNormalization):
+            n += link.avg_mean.nbytes + link.avg_var.nbytes
+    return n
+
+def load_forward(engine, path, gpu=-1):
+    """(forward, bytes held) for the model at `path`.
+
+    forward((n, h, w, 3) float32 RGB) -> (n, h, w, 3) float32 in [0, 255].
+    """
+    if engine == 'numpy':
+        from numpy_engine import NumpyStyleNet
+        model = NumpyStyleNet.load(path)
+        return model, sum(p.nbytes for p in model.params.values())
+    from inference import load_model, stylize
+    model = load_model(path, gpu)
+    return (lambda x: stylize(model, x.transpose(0, 3, 1, 2)).transpose(0, 2, 3, 1)), chainer_model_bytes(model)
+
+def discover(path, engine='chainer'):
+    """{style name: path} for a model file or a directory of models."""
+    if not os.path.isdir(path) or (engine == 'numpy' and any(fn.endswith('.dat') for fn in os.listdir(path))):
+        return {os.path.splitext(os.path.basename(path.rstrip('/')))[0]: path}
+    styles = {}
+    for fn in sorted(os.listdir(path)):
+        full = os.path.join(path, fn)
+        name, ext = os.path.splitext(fn)
+        if ext in EXTENSIONS[engine] or (engine == 'numpy' and os.path.isdir(full)):
+            styles[name] = full
+    return styles
+
+class ModelRegistry(object):
+    """Loads styles on first use and keeps the most recently used ones within `max_bytes`.
+
+    The style just requested is always kept, even if it alone exceeds the
+    budget. Unknown names rescan the directory, at most once every
+    `rescan_interval` seconds, so models added after startup are picked up.
+    Thread-safe.
+    """
+
+    def __init__(self, path, engine='chainer', max_bytes=None, gpu=-1, rescan_interval=RESCAN_INTERVAL):
+        self.path = path
+        self.engine = engine
+        self.max_bytes = max_bytes
+        self.gpu = gpu
+        self.rescan_interval = rescan_interval
+        self.styles = discover(path, engine)
+        self.scanned = time.time()
+        self.models = collections.OrderedDict()
+        self.sizes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def names(self):
+        return sorted(self.styles)
+
+    def __contains__(self, name):
+        return self._known(name)
+
+    def _known(self, name, force=False):
+        if name not in self.styles and (force or time.time() - self.scanned >= self.rescan_interval):
+            self.styles = discover(self.path, self.engine)
+            self.scanned = time.time()
+        return name in self.styles
+
+    def get(self, name):
+        with self.lock:
+            if name in self.models:
+                self.hits += 1
+                self.models[name] = self.models.pop(name)
+                return self.models[name]
+            # the server already checked the name, so a worker may rescan right away
+            if not self._known(name, force=True):
+                raise KeyError('unknown style {}'.format(name))
+            self.misses += 1
+            forward, size = load_forward(self.engine, self.styles[name], self.gpu)
+            self.models[name] = forward
+            self.sizes[name] = size
+            self._evict()
+            return forward
+
+    def _evict(self):
+        while self.max_bytes is not None and len(self.models) > 1 and self.total_bytes() > self.max_bytes:
+            name, _ = self.models.popitem(last=False)
+            del self.sizes[name]
+            self.evictions += 1
+
+    def prewarm(self, names):
+        for name in names:
+            self.get(name)
+
+    def total_bytes(self):
+        return sum(self.sizes.values())
+
+    def stats(self):
+        return {'loaded': list(self.models), 'bytes': self.total_bytes(), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,299 @@
+"""HTTP style-transfer server with resident models and dynamic micro-batching (Python 3).
+
+    POST /stylize?style=NAME[&format=png]   image file as the request body -> stylized image
+    GET  /styles                            names of the available styles
+    GET  /metrics                           JSON counters
+    GET  /health
+
+Concurrent requests of the same image size are coalesced into one batched
+forward of up to --max_batch images; a batch is dispatched once it is full
+or its oldest request has waited --max_wait_ms, and only while a worker is
+free, so requests keep coalescing while all workers are busy. Models run in
+a pool of worker processes, each holding a registry.ModelRegistry that loads
+styles on first use and keeps them within --memory_mb; the event loop only
+parses requests and image headers.
+"""
+from __future__ import print_function
+import io
+import sys
+import json
+import time
+import asyncio
+import argparse
+import collections
+import concurrent.futures
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+from PIL import Image
+
+from registry import ModelRegistry
+
+FORMATS = {'jpeg': 'image/jpeg', 'png': 'image/png'}
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+_registry = None
+
+def _init_worker(engine, path, max_bytes, prewarm, gpu):
+    global _registry
+    _registry = ModelRegistry(path, engine, max_bytes, gpu)
+    _registry.prewarm(prewarm)
+
+def _ready():
+    return _registry is not None
+
+def _stylize_batch(style, blobs, fmt):
+    # runs in a worker process: decode, one batched forward, encode
+    x = np.stack([np.asarray(Image.open(io.BytesIO(b)).convert('RGB'), dtype=np.float32) for b in blobs])
+    encoded = []
+    for y in _registry.get(style)(x):
+        out = io.BytesIO()
+        Image.fromarray(np.uint8(np.clip(y, 0, 255))).save(out, format=fmt)
+        encoded.append(out.getvalue())
+    return encoded
+
+class Metrics(object):
+    """Request counters, batch-size histogram and a window of recent latencies."""
+
+    def __init__(self, window=1000):
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.queued = 0
+        self.in_flight = 0
+        self.batch_sizes = collections.Counter()
+        self.styles = collections.Counter()
+        self.latencies = collections.deque(maxlen=window)
+
+    def snapshot(self):
+        latencies = np.asarray(self.latencies) * 1000
+        return {
+            'uptime': time.time() - self.started,
+            'requests': self.requests,
+            'errors': self.errors,
+            'rejected': self.rejected,
+            'queue_depth': self.queued,
+            'batches_in_flight': self.in_flight,
+            'batch_size_histogram': dict((str(k), v) for k, v in sorted(self.batch_sizes.items())),
+            'styles': dict(self.styles),
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        }
+
+class MicroBatcher(object):
+    """Groups payloads by key into batches for `run_batch(key, payloads)` -> results.
+
+    At most `slots` batches run at once.
+    """
+
+    def __init__(self, run_batch, max_batch, max_wait, slots, metrics):
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.free = slots
+        self.metrics = metrics
+        self.pending = {}
+        self.timers = {}
+        self.ready = collections.deque()
+
+    async def submit(self, key, payload):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        group = self.pending.setdefault(key, [])
+        group.append((payload, future, loop.time()))
+        self.metrics.queued += 1
+        if len(group) >= self.max_batch:
+            self._mark_ready(key)
+        elif key not in self.timers and key not in self.ready:
+            self.timers[key] = loop.call_later(self.max_wait, self._mark_ready, key)
+        self._dispatch()
+        return await future
+
+    def _mark_ready(self, key):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if key in self.pending and key not in self.ready:
+            self.ready.append(key)
+        self._dispatch()
+
+    def _dispatch(self):
+        loop = asyncio.get_event_loop()
+        while self.free > 0 and self.ready:
+            key = self.ready.popleft()
+            group = self.pending.pop(key)
+            batch, rest = group[:self.max_batch], group[self.max_batch:]
+            if rest:
+                self.pending[key] = rest
+                wait = rest[0][2] + self.max_wait - loop.time()
+                if len(rest) >= self.max_batch or wait <= 0:
+                    self.ready.append(key)
+                else:
+                    self.timers[key] = loop.call_later(wait, self._mark_ready, key)
+            self.free -= 1
+            self.metrics.queued -= len(batch)
+            self.metrics.in_flight += 1
+            self.metrics.batch_sizes[len(batch)] += 1
+            asyncio.ensure_future(self._run(key, batch))
+
+    async def _run(self, key, batch):
+        try:
+            results = await self.run_batch(key, [payload for payload, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self.free += 1
+            self.metrics.in_flight -= 1
+            self._dispatch()
+
+class StyleServer(object):
+    """Minimal HTTP/1.1 front end over a MicroBatcher and a worker pool."""
+
+    def __init__(self, executor, registry, workers, max_batch=4, max_wait=0.01, max_queue=64,
+                 max_body=32 * 2 ** 20):
+        self.executor = executor
+        self.registry = registry  # only used for the style names, models live in the workers
+        self.max_queue = max_queue
+        self.max_body = max_body
+        self.metrics = Metrics()
+        self.batcher = MicroBatcher(self._run_batch, max_batch, max_wait, workers, self.metrics)
+
+    async def _run_batch(self, key, blobs):
+        style, size, fmt = key
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, _stylize_batch, style, blobs, fmt)
+
+    async def stylize(self, query, body):
+        fmt = query.get('format', ['jpeg'])[0].lower()
+        if fmt not in FORMATS:
+            return 400, 'text/plain', 'unknown format {}\n'.format(fmt).encode()
+        names = self.registry.names()
+        style = query.get('style', names if len(names) == 1 else [None])[0]
+        if style is None:
+            return 400, 'text/plain', b'style is required\n'
+        if style not in self.registry:
+            return 404, 'text/plain', 'unknown style {}\n'.format(style).encode()
+        try:
+            size = Image.open(io.BytesIO(body)).size  # header only
+        except Exception:
+            return 400, 'text/plain', b'cannot identify image\n'
+        if self.metrics.queued >= self.max_queue:
+            self.metrics.rejected += 1
+            return 503, 'text/plain', b'queue full\n'
+        start = time.time()
+        try:
+            result = await self.batcher.submit((style, size, fmt), body)
+        except Exception as e:
+            self.metrics.errors += 1
+            return 500, 'text/plain', '{}\n'.format(e).encode()
+        self.metrics.latencies.append(time.time() - start)
+        self.metrics.styles[style] += 1
+        return 200, FORMATS[fmt], result
+
+    async def route(self, method, target, body):
+        url = urlsplit(target)
+        if url.path == '/stylize':
+            if method != 'POST':
+                return 405, 'text/plain', b'POST an image\n'
+            self.metrics.requests += 1
+            return await self.stylize(parse_qs(url.query), body)
+        if url.path == '/styles':
+            return 200, 'application/json', json.dumps(self.registry.names()).encode()
+        if url.path == '/metrics':
+            return 200, 'application/json', json.dumps(self.metrics.snapshot(), indent=2).encode()
+        if url.path == '/health':
+            return 200, 'text/plain', b'ok\n'
+        return 404, 'text/plain', b'not found\n'
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, version = line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > self.max_body:
+                    status, content_type, payload = 413, 'text/plain', b'too large\n'
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, content_type, payload = await self.route(method, target, body)
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                    status, REASONS[status], content_type, len(payload),
+                    'keep-alive' if keep_alive else 'close').encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+def make_executor(engine, path, workers, max_bytes=None, prewarm=(), gpu=-1):
+    """Process pool whose workers have loaded the `prewarm` styles before the first request."""
+    executor = concurrent.futures.ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(engine, path, max_bytes, list(prewarm), gpu))
+    for future in [executor.submit(_ready) for _ in range(workers)]:
+        future.result()
+    return executor
+
+def main():
+    parser = argparse.ArgumentParser(description='Style-transfer HTTP server with dynamic micro-batching')
+    parser.add_argument('model', help='model file or directory of models (.model files, or weight bundles '
+                                      'and .dat folders with --engine numpy)')
+    parser.add_argument('--engine', default='chainer', choices=('chainer', 'numpy'))
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', '-p', default=8000, type=int)
+    parser.add_argument('--gpu', '-g', default=-1, type=int, help='GPU ID (negative value indicates CPU)')
+    parser.add_argument('--workers', '-w', default=1, type=int, help='worker processes, each holding the model')
+    parser.add_argument('--max_batch', default=4, type=int)
+    parser.add_argument('--max_wait_ms', default=10., type=float,
+                        help='longest time a request waits for others of its size')
+    parser.add_argument('--max_queue', default=64, type=int, help='requests waiting beyond this get 503')
+    parser.add_argument('--memory_mb', default=None, type=float,
+                        help='budget of loaded models per worker, least recently used styles are evicted')
+    parser.add_argument('--prewarm', nargs='*', default=None,
+                        help='styles to load at startup (default: all of them if a single file is given)')
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.model, args.engine)
+    if not registry.names():
+        parser.error('no models found in {}'.format(args.model))
+    prewarm = args.prewarm if args.prewarm is not None else (registry.names() if len(registry.names()) == 1 else [])
+    for name in prewarm:
+        if name not in registry:
+            parser.error('unknown style {}'.format(name))
+    max_bytes = args.memory_mb * 2 ** 20 if args.memory_mb is not None else None
+    executor = make_executor(args.engine, args.model, args.workers, max_bytes, prewarm, args.gpu)
+    server = StyleServer(executor, registry, args.workers, args.max_batch, args.max_wait_ms / 1000., args.max_queue)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    listener = loop.run_until_complete(asyncio.start_server(server.handle, args.host, args.port))
+    print('serving on http://{}:{}'.format(args.host, args.port), file=sys.stderr)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        executor.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+from PIL import Image
+
+from inference import load_model, stylize, to_images
+from pipeline import prefetch, Sink, StageStats
+from incremental import IncrementalStylizer
+import batch
+import tiling
+
+def read_sequence(paths):
+    for path in paths:
+        yield os.path.basename(path), path
+
+def read_raw(stream, width, height):
+    frame_bytes = width * height * 3
+    index = 0
+    while True:
+        data = stream.read(frame_bytes)
+        if len(data) < frame_bytes:
+            break
+        yield 'frame_{:06d}.png'.format(index), data
+        index += 1
+
+def decode_frame(item, size=None):
+    name, data = item
+    if size is None:
+        image = np.asarray(Image.open(data).convert('RGB'), dtype=np.float32)
+    else:
+        width, height = size
+        image = np.frombuffer(data, dtype=np.uint8).reshape((height, width, 3)).astype(np.float32)
+    return name, image.transpose(2, 0, 1)
+
+def pad_frame(image, size):
+    """Edge-pads an (h, w, 3) output to `size` = (width, height), undoing the network's crop to a multiple of 4."""
+    width, height = size
+    h, w = image.shape[:2]
+    if (h, w) == (height, width):
+        return image
+    return np.pad(image[:height, :width], ((0, max(height - h, 0)), (0, max(width - w, 0)), (0, 0)), mode='edge')
+
+def group_frames(frames, batchsize):
+    names, images = [], []
+    for name, image in frames:
+        if images and (len(images) == batchsize or image.shape != images[0].shape):
+            yield names, np.stack(images)
+            names, images = [], []
+        names.append(name)
+        images.append(image)
+    if images:
+        yield names, np.stack(images)
+
+class Pipeline(object):
+    """decode -> inference -> encode, each on its own thread with bounded queues in between.
+
+    With an IncrementalStylizer as `incremental`, frames are stylized one at
+    a time through it instead of in batches.
+    """
+
+    def __init__(self, model, decode, encode, batchsize=1, depth=4, incremental=None):
+        self.model = model
+        self.incremental = incremental
+        self.batchsize = 1 if incremental else batchsize
+        self.depth = depth
+        self.stats = [StageStats('decode'), StageStats('inference'), StageStats('encode')]
+        self.decode = self.stats[0].timed(decode)
+        if incremental:
+            self.infer = self.stats[1].timed(lambda x: incremental(x[0])[np.newaxis])
+        else:
+            self.infer = self.stats[1].timed(lambda x: stylize(self.model, x))
+        self.encode = self.stats[2].timed(encode)
+        self.latency = StageStats('end_to_end')
+        self.frames = 0
+        self.start = None
+        self.report_every = 0
+
+    def _decoded(self, source):
+        for item in source:
+            yield time.time(), self.decode(item)
+
+    def _stylized(self, decoded):
+        pending = []
+        def frames():
+            for t, frame in decoded:
+                pending.append(t)
+                yield frame
+        for names, x in group_frames(frames(), self.batchsize):
+            started = pending[:len(names)]
+            del pending[:len(names)]
+            yield started, names, self.infer(x)
+
+    def _write(self, item):
+        started, names, result = item
+        for t, name, image in zip(started, names, to_images(result)):
+            self.encode(name, image)
+            self.latency.times.append(time.time() - t)
+            self.frames += 1
+            if self.report_every and self.frames % self.report_every == 0:
+                print(self.report_line(), file=sys.stderr)
+
+    def run(self, source, report_every=0):
+        self.start = time.time()
+        self.report_every = report_every
+        decoded = prefetch(self._decoded(source), self.depth)
+        stylized = prefetch(self._stylized(decoded), self.depth)
+        with Sink(self._write, self.depth) as sink:
+            for item in stylized:
+                sink.put(item)
+        return self.report()
+
+    def fps(self):
+        elapsed = time.time() - self.start
+        return self.frames / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        stages = dict((s.name, s.summary()) for s in self.stats + [self.latency])
+        report = {'frames': self.frames, 'seconds': time.time() - self.start, 'fps': self.fps(), 'stages': stages}
+        if self.incremental:
+            report['incremental'] = self.incremental.summary()
+        return report
+
+    def report_line(self):
+        means = ['{} {:.1f}ms'.format(s.name, np.mean(s.times[-50:]) * 1000) for s in self.stats if s.times]
+        if self.incremental:
+            means.append('recomputed {:.1f}%'.format(np.mean(self.incremental.recomputed[-50:]) * 100))
+        return '{} frames, {:.2f} fps ({})'.format(self.frames, self.fps(), ', '.join(means))
+
+def main():
+    parser = argparse.ArgumentParser(description='Streaming style transfer for image sequences and raw RGB video')
+    parser.add_argument('input', help='frame directory, glob pattern or @list file; "-" reads raw RGB24 frames from stdin')
+    parser.add_argument('--size', type=str, default=None, help='WIDTHxHEIGHT of raw stdin frames')
+    parser.add_argument('--gpu', '-g', default=-1, type=int,
+                        help='GPU ID (negative value indicates CPU)')
+    parser.add_argument('--model', '-m', default='models/style.model', type=str)
+    parser.add_argument('--out', '-o', default='out', type=str,
+                        help='output frame directory; "-" writes raw RGB24 frames to stdout')
+    parser.add_argument('--batchsize', '-b', default=1, type=int)
+    parser.add_argument('--queue', default=4, type=int, help='capacity of the queues between stages')
+    parser.add_argument('--report_every', default=100, type=int, help='print throughput every N frames (0 disables)')
+    parser.add_argument('--stats', default=None, type=str, help='write the final throughput report to this JSON file')
+    parser.add_argument('--incremental', action='store_true',
+                        help='recompute only the regions that changed since the previous frames')
+    parser.add_argument('--tile', default=32, type=int, help='size of the tiles compared in incremental mode')
+    parser.add_argument('--threshold', default=8., type=float,
+                        help='largest per-pixel change (0-255) of a tile still treated as unchanged')
+    parser.add_argument('--keyframe_interval', default=60, type=int,
+                        help='recompute the whole frame every N frames in incremental mode (0 disables)')
+    parser.add_argument('--halo', default=None, type=int,
+                        help='context pixels around recomputed regions (default covers the receptive field of the model, {}px with 5 residual blocks)'.format(tiling.default_halo()))
+    args = parser.parse_args()
+
+    if args.input == '-':
+        if args.size is None:
+            parser.error('--size is required for raw stdin input')
+        size = tuple(int(v) for v in args.size.lower().split('x'))
+        source = read_raw(getattr(sys.stdin, 'buffer', sys.stdin), *size)
+    else:
+        size = None
+        source = read_sequence(batch.expand_inputs([args.input]))
+
+    if args.out == '-':
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        def encode(name, image):
+            if size is not None:
+                image = pad_frame(image, size)
+            stdout.write(image.tobytes())
+    else:
+        if not os.path.isdir(args.out):
+            os.makedirs(args.out)
+        def encode(name, image):
+            Image.fromarray(image).save(os.path.join(args.out, name))
+
+    model = load_model(args.model, args.gpu)
+    incremental = None
+    if args.incremental:
+        halo = args.halo
+        if halo is None:
+            halo = tiling.default_halo(tiling.fast_style_layers(model.n_residual))
+        incremental = IncrementalStylizer(lambda x: stylize(model, x), args.tile, args.threshold,
+                                          args.keyframe_interval, halo)
+    pipeline = Pipeline(model, lambda item: decode_frame(item, size), encode, args.batchsize, args.queue,
+                        incremental)
+    report = pipeline.run(source, args.report_every)
+    print(json.dumps(report, indent=2, sort_keys=True), file=sys.stderr)
+    if args.stats:
+        with open(args.stats, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
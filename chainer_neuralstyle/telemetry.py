@@ -0,0 +1,118 @@
+"""Training step telemetry written as JSON lines.
+
+Each record covers `every` steps: images/sec over the interval, the mean
+time of every phase of a step and the mean loss components, both taken
+over the sampled steps, and the peak RSS of the process. Only every
+`sample`-th step is timed phase by phase; on the GPU that means
+synchronizing the device at each phase boundary, which the other steps
+skip. The first record holds the configuration of the run.
+"""
+import sys
+import json
+import time
+
+from chainer import cuda
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024. ** 2 if sys.platform == 'darwin' else 1024.)
+
+class Telemetry(object):
+    """Times the phases of training steps and appends a JSON record to `path` every `every` steps.
+
+    A step is begin(), then lap(name) at the end of each phase, then end().
+    The data phase runs from the end of the previous step of the epoch, so
+    it includes the wait for the loader. `images_per_step` counts all
+    workers. `synchronize`, if given, waits for the device before every
+    lap of a sampled step. With `path` None nothing is timed or written.
+    """
+
+    def __init__(self, path, images_per_step, every=100, sample=10, synchronize=None, config=None):
+        self.f = open(path, 'a') if path else None
+        self.images_per_step = images_per_step
+        self.every = every
+        self.sample = max(sample, 1)
+        self.synchronize = synchronize
+        self.steps = 0
+        self.epoch = None
+        self.iteration = None
+        self.step_end = None
+        self.sampled = False
+        self.last = None
+        self._reset()
+        self._write({'type': 'config', 'time': time.time(), 'every': every, 'sample': self.sample,
+                     'images_per_step': images_per_step, 'config': config or {}})
+
+    def _reset(self):
+        self.interval_start = time.time()
+        self.interval_steps = 0
+        self.sampled_steps = 0
+        self.phases = {}
+        self.losses = {}
+
+    def _write(self, record):
+        if self.f is None:
+            return
+        self.f.write(json.dumps(record, sort_keys=True) + '\n')
+        self.f.flush()
+
+    def begin(self, epoch, iteration):
+        if epoch != self.epoch:
+            # the gap before the first step of an epoch holds the epoch-end checkpoint, not data loading
+            self.step_end = None
+            if self.interval_steps == 0:
+                self.interval_start = time.time()
+        self.epoch, self.iteration = epoch, iteration
+        self.sampled = self.f is not None and self.steps % self.sample == 0
+        self.last = time.time() if self.step_end is None else self.step_end
+
+    def lap(self, name):
+        if not self.sampled:
+            return
+        if self.synchronize is not None:
+            self.synchronize()
+        now = time.time()
+        self.phases[name] = self.phases.get(name, 0.) + now - self.last
+        self.last = now
+
+    def end(self, losses=None):
+        """Ends the step; `losses` maps names to loss Variables, read only on sampled steps."""
+        if self.sampled:
+            for name, loss in (losses or {}).items():
+                self.losses[name] = self.losses.get(name, 0.) + float(cuda.to_cpu(loss.data))
+            self.sampled_steps += 1
+        self.steps += 1
+        self.interval_steps += 1
+        self.step_end = time.time()
+        if self.interval_steps >= self.every:
+            self.flush()
+
+    def flush(self):
+        """Writes the record of the steps since the last one, if any."""
+        if self.f is None or self.interval_steps == 0:
+            return
+        seconds = time.time() - self.interval_start
+        n = max(self.sampled_steps, 1)
+        self._write({
+            'type': 'steps', 'time': time.time(), 'epoch': self.epoch, 'iteration': self.iteration,
+            'steps': self.interval_steps, 'sampled_steps': self.sampled_steps, 'seconds': seconds,
+            'step_ms': seconds / self.interval_steps * 1000,
+            'images_per_sec': self.interval_steps * self.images_per_step / seconds if seconds > 0 else None,
+            'phases_ms': dict((k, v / n * 1000) for k, v in self.phases.items()),
+            'loss': dict((k, v / n) for k, v in self.losses.items()),
+            'peak_rss_mb': peak_rss_mb(),
+        })
+        self._reset()
+
+    def close(self):
+        self.flush()
+        if self.f is not None:
+            self.f.close()
@@ -0,0 +1,103 @@
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+# c2 and c3 halve the resolution twice, so tiles have to start on multiples of 4
+# for their stride-2 sampling grid to line up with the one of the whole image.
+ALIGN = 4
+
+def fast_style_layers(n_residual=5):
+    """Geometry of FastStyleNet as (kind, ksize, stride, pad), input to output."""
+    layers = [('conv', 9, 1, 4), ('conv', 4, 2, 1), ('conv', 4, 2, 1)]
+    layers += [('conv', 3, 1, 1)] * (2 * n_residual)
+    layers += [('deconv', 4, 2, 1), ('deconv', 4, 2, 1), ('deconv', 9, 1, 4)]
+    return layers
+
+def receptive_field_radius(layers=None):
+    """Number of input pixels on either side that affect one output pixel."""
+    if layers is None:
+        layers = fast_style_layers()
+    radius = 0
+    for o in range(8):
+        lo, hi = o, o
+        for kind, k, s, p in reversed(layers):
+            if kind == 'conv':
+                lo, hi = lo * s - p, hi * s - p + k - 1
+            else:
+                lo, hi = -(-(lo + p - k + 1) // s), (hi + p) // s
+        radius = max(radius, o - lo, hi - o)
+    return radius
+
+def default_halo(layers=None):
+    r = receptive_field_radius(layers)
+    return -(-r // ALIGN) * ALIGN
+
+def _ramp(length, start_fade, end_fade, overlap):
+    w = np.ones(length, dtype=np.float32)
+    if overlap > 0:
+        ramp = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap
+        if start_fade:
+            w[:overlap] = ramp[:length]
+        if end_fade:
+            w[-overlap:] = np.minimum(w[-overlap:], ramp[::-1][-length:])
+    return w
+
+def crop_span(start, stop, size, halo):
+    """Input span, on the stride grid, whose output covers [start, stop) with `halo` pixels of context."""
+    c0 = max((start - halo) // ALIGN * ALIGN, 0)
+    c1 = min(stop + halo, size)
+    if c1 < size:
+        c1 = c0 + -(-(c1 - c0) // ALIGN) * ALIGN
+    return c0, min(c1, size)
+
+def _spans(size, tile, overlap, halo):
+    # (core start, core stop, blend start, blend stop, crop start, crop stop)
+    spans = []
+    for start in range(0, size, tile):
+        stop = min(start + tile, size)
+        b0, b1 = max(start - overlap, 0), min(stop + overlap, size)
+        spans.append((start, stop, b0, min(b1, size)) + crop_span(b0, b1, size, halo))
+    return spans
+
+def tiled_stylize(forward, image, tile=512, halo=None, overlap=16, workers=1):
+    """Runs `forward` over overlapping tiles of `image` and feather-blends the results.
+
+    `forward` maps a (1, 3, h, w) float32 array to its (1, 3, h, w) stylized
+    output, `image` is a (3, H, W) float32 array. Each tile is cropped with
+    `halo` extra pixels on every side; with the default halo, which covers the
+    receptive field, the seams are exact and blending only matters when a
+    smaller halo is traded for speed. Peak memory is bounded by `workers`
+    tiles of about (tile + 2 * (halo + overlap)) pixels squared.
+    """
+    if halo is None:
+        halo = default_halo()
+    tile = max(tile // ALIGN * ALIGN, ALIGN)
+    overlap = min(overlap, tile // 2)
+    _, height, width = image.shape
+    out_h, out_w = height // ALIGN * ALIGN, width // ALIGN * ALIGN
+    rows = _spans(out_h, tile, overlap, halo)
+    cols = _spans(out_w, tile, overlap, halo)
+    jobs = [(r, c) for r in rows for c in cols]
+
+    def run(job):
+        r, c = job
+        crop = image[:, r[4]:r[5] if r[5] < out_h else height, c[4]:c[5] if c[5] < out_w else width]
+        y = forward(crop[np.newaxis])[0]
+        return job, y[:, r[2] - r[4]:r[3] - r[4], c[2] - c[4]:c[3] - c[4]]
+
+    result = np.zeros((3, out_h, out_w), dtype=np.float32)
+    weight = np.zeros((out_h, out_w), dtype=np.float32)
+    pool = ThreadPool(workers) if workers > 1 else None
+    try:
+        results = pool.imap_unordered(run, jobs) if pool else (run(job) for job in jobs)
+        for (r, c), y in results:
+            wy = _ramp(r[3] - r[2], r[2] > 0, r[3] < out_h, 2 * overlap)
+            wx = _ramp(c[3] - c[2], c[2] > 0, c[3] < out_w, 2 * overlap)
+            w = np.outer(wy, wx)
+            result[:, r[2]:r[3], c[2]:c[3]] += y * w
+            weight[r[2]:r[3], c[2]:c[3]] += w
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return result / weight
@@ -1,24 +1,16 @@
 import numpy as np
 import os, re
+import time
 import argparse
 from PIL import Image
 
 from chainer import cuda, Variable, optimizers, serializers
 from net import *
-
-def load_image(path, size):
-    image = Image.open(path).convert('RGB')
-    w,h = image.size
-    if w < h:
-        if w < size:
-            image = image.resize((size, size*h/w))
-            w, h = image.size
-    else:
-        if h < size:
-            image = image.resize((size*w/h, size))
-            w, h = image.size
-    image = image.crop(((w-size)*0.5, (h-size)*0.5, (w+size)*0.5, (h+size)*0.5))
-    return xp.asarray(image, dtype=np.float32).transpose(2, 0, 1)
+from image_cache import list_images, build_cache, CachedImages, ImageFiles, PrefetchLoader
+from feature_cache import FeatureCache, hash_file
+from checkpoint import CheckpointWriter, latest_checkpoint
+from parallel import SharedAllreduce, GradientSync, parameter_count, running_stats_count, shard, launch
+from telemetry import Telemetry
 
 def gram_matrix(y):
     b, ch, h, w = y.data.shape
@@ -27,15 +19,12 @@ def gram_matrix(y):
     return gram
 
 def total_variation_regularization(x, beta=1):
-    xp = cuda.get_array_module(x.data)
-    wh = Variable(xp.array([[[[1],[-1]],[[1],[-1]],[[1],[-1]]]], dtype=xp.float32))
-    ww = Variable(xp.array([[[[1, -1]],[[1, -1]],[[1, -1]]]], dtype=xp.float32))
-    tvh = lambda x: F.convolution_2d(x, W=wh, pad=1)
-    tvw = lambda x: F.convolution_2d(x, W=ww, pad=1)
-
-    dh = tvh(x)
-    dw = tvw(x)
-    tv = (F.sum(dh**2) + F.sum(dw**2)) ** (beta / 2.)
+    # Same value as convolving with zero padding and the [1, -1] difference filters
+    # summed over the channels, computed with slices on the channel sum instead.
+    s = F.sum(x, axis=1)
+    dh = F.sum((s[:, 1:] - s[:, :-1])**2) + F.sum(s[:, 0]**2) + F.sum(s[:, -1]**2)
+    dw = F.sum((s[:, :, 1:] - s[:, :, :-1])**2) + F.sum(s[:, :, 0]**2) + F.sum(s[:, :, -1]**2)
+    tv = (dh + dw) ** (beta / 2.)
     return tv
 
 parser = argparse.ArgumentParser(description='Real-time style transfer')
@@ -50,7 +39,8 @@ parser.add_argument('--batchsize', '-b', type=int, default=1,
 parser.add_argument('--initmodel', '-i', default=None, type=str,
                     help='initialize the model from given file')
 parser.add_argument('--resume', '-r', default=None, type=str,
-                    help='resume the optimization from snapshot')
+                    help='resume the optimization from snapshot, or "latest" to continue from the newest '
+                         'complete checkpoint (model and optimizer) of this output')
 parser.add_argument('--output', '-o', default=None, type=str,
                     help='output model file path without extension')
 parser.add_argument('--lambda_tv', default=10e-4, type=float,
@@ -59,9 +49,47 @@ parser.add_argument('--lambda_feat', default=1e0, type=float)
 parser.add_argument('--lambda_style', default=1e1, type=float)
 parser.add_argument('--epoch', '-e', default=2, type=int)
 parser.add_argument('--lr', '-l', default=1e-3, type=float)
-parser.add_argument('--checkpoint', '-c', default=0, type=int)
+parser.add_argument('--checkpoint', '-c', default=0, type=int,
+                    help='save a checkpoint every this many iterations')
+parser.add_argument('--checkpoint_interval', default=None, type=float,
+                    help='save a checkpoint every this many seconds')
+parser.add_argument('--keep_checkpoints', default=0, type=int,
+                    help='number of periodic checkpoints kept (default: all)')
 parser.add_argument('--image_size', default=256, type=int)
+parser.add_argument('--cache', default=None, type=str,
+                    help='preprocessed image cache directory, built from the dataset on first use')
+parser.add_argument('--loaderjob', '-j', default=2, type=int,
+                    help='number of processes assembling batches (0 uses a background thread)')
+parser.add_argument('--prefetch', default=4, type=int,
+                    help='number of batches prepared ahead of the training step')
+parser.add_argument('--feature_cache', default=None, type=str,
+                    help='directory caching the conv3_3 content targets, so later epochs skip vgg(xc)')
+parser.add_argument('--feature_cache_size', default=None, type=float,
+                    help='size cap of the feature cache in GB (default: unbounded)')
+parser.add_argument('--feature_cache_dtype', default='float16', choices=('float16', 'float32'))
+parser.add_argument('--fused_vgg', action='store_true',
+                    help='run the content and stylized images through VGG as one concatenated batch')
+parser.add_argument('--workers', '-w', default=1, type=int,
+                    help='data-parallel training processes (CPU only), each taking every n-th batch')
+parser.add_argument('--seed', default=0, type=int,
+                    help='random seed of the model initialization')
+parser.add_argument('--width', default=None, type=float,
+                    help='channel width multiplier of a new model (default 1.0, which is 32/64/128 channels)')
+parser.add_argument('--n_residual', default=None, type=int,
+                    help='number of residual blocks of a new model (default 5)')
+parser.add_argument('--teacher', '-t', default=None, type=str,
+                    help='distill from this trained model: its stylized images replace the content images as the target of L_feat')
+parser.add_argument('--telemetry', default=None, type=str,
+                    help='append per-step timing, throughput, loss and memory records to this JSONL file')
+parser.add_argument('--telemetry_every', default=100, type=int,
+                    help='steps covered by one telemetry record')
+parser.add_argument('--telemetry_sample', default=10, type=int,
+                    help='time the phases of every n-th step only (on the GPU each timed phase synchronizes)')
 args = parser.parse_args()
+if args.workers > 1 and args.gpu >= 0:
+    raise SystemExit('--workers is for CPU training, use a single process with --gpu')
+if args.teacher and args.feature_cache:
+    raise SystemExit('--feature_cache holds the features of the content images, which --teacher replaces')
 
 batchsize = args.batchsize
 
@@ -72,87 +100,207 @@ lambda_f = args.lambda_feat
 lambda_s = args.lambda_style
 style_prefix, _ = os.path.splitext(os.path.basename(args.style_image))
 output = style_prefix if args.output == None else args.output
-fs = os.listdir(args.dataset)
-imagepaths = []
-for fn in fs:
-    base, ext = os.path.splitext(fn)
-    if ext == '.jpg' or ext == '.png':
-        imagepath = os.path.join(args.dataset,fn)
-        imagepaths.append(imagepath)
-n_data = len(imagepaths)
+latest = latest_checkpoint('models', output) if args.resume == 'latest' else None
+
+# A model that training continues from keeps the configuration it was saved
+# with, --width and --n_residual (and any other such model) only have to match it.
+for path in [p for p in (args.initmodel, latest and latest[0]) if p]:
+    config = {'width': 1.0, 'n_residual': 5}
+    config.update(saved_config(path))
+    for key, value in sorted(config.items()):
+        if getattr(args, key) is not None and getattr(args, key) != value:
+            raise SystemExit('{} has {} {}, not {}'.format(path, key, value, getattr(args, key)))
+        setattr(args, key, value)
+args.width = 1.0 if args.width is None else args.width
+args.n_residual = 5 if args.n_residual is None else args.n_residual
+if args.cache and CachedImages.exists(args.cache):
+    images = CachedImages(args.cache)
+    if images.image_size != image_size:
+        raise SystemExit('cache {} holds {}px images, not {}px'.format(args.cache, images.image_size, image_size))
+else:
+    imagepaths = list_images(args.dataset)
+    if args.cache:
+        print 'building image cache in', args.cache
+        build_cache(imagepaths, args.cache, image_size, workers=max(args.loaderjob, 1))
+        images = CachedImages(args.cache)
+    else:
+        images = ImageFiles(imagepaths, image_size)
+n_data = len(images)
 print 'num traning images:', n_data
-n_iter = n_data / batchsize
-print n_iter, 'iterations,', n_epoch, 'epochs'
-
-model = FastStyleNet()
-vgg = VGG()
-serializers.load_npz('vgg16.model', vgg)
-if args.initmodel:
-    print 'load model from', args.initmodel
-    serializers.load_npz(args.initmodel, model)
-if args.gpu >= 0:
-    cuda.get_device(args.gpu).use()
-    model.to_gpu()
-    vgg.to_gpu()
-xp = np if args.gpu < 0 else cuda.cupy
-
-O = optimizers.Adam(alpha=args.lr)
-O.setup(model)
-if args.resume:
-    print 'load optimizer state from', args.resume
-    serializers.load_npz(args.resume, O)
-
-style = vgg.preprocess(np.asarray(Image.open(args.style_image).convert('RGB').resize((image_size,image_size)), dtype=np.float32))
-style = xp.asarray(style, dtype=xp.float32)
-style_b = xp.zeros((batchsize,) + style.shape, dtype=xp.float32)
-for i in range(batchsize):
-    style_b[i] = style
-feature_s = vgg(Variable(style_b, volatile=True))
-gram_s = [gram_matrix(y) for y in feature_s]
-
-for epoch in range(n_epoch):
-    print 'epoch', epoch
-    for i in range(n_iter):
-        model.zerograds()
-        vgg.zerograds()
-
-        indices = range(i * batchsize, (i+1) * batchsize)
-        x = xp.zeros((batchsize, 3, image_size, image_size), dtype=xp.float32)
-        for j in range(batchsize):
-            x[j] = load_image(imagepaths[i*batchsize + j], image_size)
-
-        xc = Variable(x.copy(), volatile=True)
-        x = Variable(x)
-
-        y = model(x)
-
-        xc -= 120
-        y -= 120
-
-        feature = vgg(xc)
-        feature_hat = vgg(y)
-
-        L_feat = lambda_f * F.mean_squared_error(Variable(feature[2].data), feature_hat[2]) # compute for only the output of layer conv3_3
-
-        L_style = Variable(xp.zeros((), dtype=np.float32))
-        for f, f_hat, g_s in zip(feature, feature_hat, gram_s):
-            L_style += lambda_s * F.mean_squared_error(gram_matrix(f_hat), Variable(g_s.data))
-
-        L_tv = lambda_tv * total_variation_regularization(y)
-        L = L_feat + L_style + L_tv
-
-        print '(epoch {}) batch {}/{}... training loss is...{}'.format(epoch, i, n_iter, L.data)
-
-        L.backward()
-        O.update()
-
-        if args.checkpoint > 0 and i % args.checkpoint == 0:
-            serializers.save_npz('models/{}_{}_{}.model'.format(output, epoch, i), model)
-            serializers.save_npz('models/{}_{}_{}.state'.format(output, epoch, i), O)
-
-    print 'save "style.model"'
-    serializers.save_npz('models/{}_{}.model'.format(output, epoch), model)
-    serializers.save_npz('models/{}_{}.state'.format(output, epoch), O)
-
-serializers.save_npz('models/{}.model'.format(output), model)
-serializers.save_npz('models/{}.state'.format(output), O)
+n_iter = n_data / batchsize / args.workers
+print n_iter, 'iterations,', n_epoch, 'epochs', '({} workers)'.format(args.workers) if args.workers > 1 else ''
+# Step k of rank r trains on global batch k * workers + r, the same split on every run.
+batch_indices = [range(i * batchsize, (i+1) * batchsize) for i in range(n_data / batchsize)]
+
+def train(rank=0, n_workers=1, reducer=None, stats_reducer=None):
+    # Only rank 0 reports and saves; all ranks hold identical parameters.
+    main = rank == 0
+    np.random.seed(args.seed + rank)
+    loader = PrefetchLoader(images, args.loaderjob, args.prefetch)
+
+    model = FastStyleNet(args.width, args.n_residual)
+    if main:
+        print 'model: width {}, {} residual blocks, {} parameters'.format(
+            args.width, args.n_residual, parameter_count(model))
+    teacher = None
+    if args.teacher:
+        if main:
+            print 'distill from', args.teacher
+        teacher = load_style_net(args.teacher)
+    # conv3_3 for the content loss, conv1_2 .. conv4_3 for the style loss; conv5 is never used
+    vgg = VGG(n_blocks=4 if lambda_s > 0 else 3)
+    serializers.load_npz('vgg16.model', vgg)
+    feature_cache = None
+    if args.feature_cache:
+        max_bytes = None if args.feature_cache_size is None else int(args.feature_cache_size * 1024**3)
+        feature_cache = FeatureCache(args.feature_cache, hash_file('vgg16.model'), image_size,
+                                     args.feature_cache_dtype, max_bytes)
+    if args.initmodel:
+        if main:
+            print 'load model from', args.initmodel
+        serializers.load_npz(args.initmodel, model)
+    start_epoch, start_iteration = 0, 0
+    if latest:
+        model_path, state_path, start_epoch, start_iteration = latest
+        if main:
+            print 'resume from', model_path, 'at epoch', start_epoch, 'iteration', start_iteration
+        serializers.load_npz(model_path, model)
+    elif args.resume == 'latest' and main:
+        print 'no checkpoint of', output, 'found, starting from scratch'
+    if args.gpu >= 0:
+        cuda.get_device(args.gpu).use()
+        model.to_gpu()
+        vgg.to_gpu()
+        if teacher is not None:
+            teacher.to_gpu()
+    xp = np if args.gpu < 0 else cuda.cupy
+
+    sync = None
+    if reducer is not None:
+        reducer.attach(rank)
+        stats_reducer.attach(rank)
+        sync = GradientSync(model, reducer, stats_reducer)
+        sync.broadcast_params()
+
+    O = optimizers.Adam(alpha=args.lr)
+    O.setup(model)
+    if latest:
+        serializers.load_npz(state_path, O)
+    elif args.resume and args.resume != 'latest':
+        if main:
+            print 'load optimizer state from', args.resume
+        serializers.load_npz(args.resume, O)
+    writer = None
+    if main:
+        writer = CheckpointWriter('models', output, args.checkpoint, args.checkpoint_interval, args.keep_checkpoints)
+    synchronize = cuda.get_device(args.gpu).synchronize if args.gpu >= 0 else None
+    telemetry = Telemetry(args.telemetry if main else None, batchsize * n_workers, args.telemetry_every,
+                          args.telemetry_sample, synchronize, vars(args))
+
+    style = vgg.preprocess(np.asarray(Image.open(args.style_image).convert('RGB').resize((image_size,image_size)), dtype=np.float32))
+    style = xp.asarray(style, dtype=xp.float32)
+    # The grams of the style image are computed once and broadcast over the batch.
+    feature_s = vgg(Variable(style[np.newaxis], volatile=True))
+    gram_s = [xp.broadcast_to(gram_matrix(y).data, (batchsize,) + y.data.shape[1:2] * 2) for y in feature_s]
+
+    steps = shard(batch_indices, rank, n_workers)
+    for epoch in range(start_epoch, n_epoch):
+        if main:
+            print 'epoch', epoch
+        start = time.time()
+        first = start_iteration if epoch == start_epoch else 0
+        batches = loader.batches(steps[first:])
+        for i, x in enumerate(batches, first):
+            telemetry.begin(epoch, i)
+            model.zerograds()
+            vgg.zerograds()
+
+            x = xp.asarray(x)
+            telemetry.lap('data')
+
+            if teacher is not None:
+                # the content target is the teacher's stylization of the batch, with the statistics
+                # of each image as generate.py --bn batch serves it (see inference.stylize)
+                y_t = [teacher(Variable(x[k:k + 1], volatile=True), test=False) for k in range(len(x))]
+                xc = Variable(F.concat(y_t, axis=0).data, volatile=not args.fused_vgg)
+                telemetry.lap('teacher')
+            else:
+                xc = Variable(x.copy(), volatile=not args.fused_vgg)
+            x = Variable(x)
+
+            y = model(x)
+            telemetry.lap('forward')
+
+            xc -= 120
+            y -= 120
+
+            # Only conv3_3 of the content image is used (for L_feat), so it can come from the cache.
+            paths = [images.paths[j] for j in steps[i]]
+            cached = [feature_cache.get(p) for p in paths] if feature_cache else [None]
+            if all(f is not None for f in cached):
+                feature_c = xp.asarray(np.stack(cached), dtype=xp.float32)
+                feature_hat = vgg(y)
+            else:
+                if args.fused_vgg:
+                    features = vgg(F.concat((xc, y), axis=0))
+                    feature_c = features[2].data[:batchsize]
+                    feature_hat = [F.split_axis(f, [batchsize], axis=0)[1] for f in features]
+                else:
+                    feature_c = vgg(xc)[2].data
+                    feature_hat = vgg(y)
+                if feature_cache:
+                    for p, f in zip(paths, cuda.to_cpu(feature_c)):
+                        feature_cache.put(p, f)
+            telemetry.lap('vgg')
+
+            L_feat = lambda_f * F.mean_squared_error(Variable(feature_c), feature_hat[2]) # compute for only the output of layer conv3_3
+
+            # gram_matrix is already one batch_matmul over the whole batch per layer; the
+            # four layers have 64/128/256/512 channels, so their grams cannot share one op.
+            L_style = Variable(xp.zeros((), dtype=np.float32))
+            for f_hat, g_s in zip(feature_hat, gram_s):
+                L_style += lambda_s * F.mean_squared_error(gram_matrix(f_hat), Variable(g_s))
+
+            L_tv = lambda_tv * total_variation_regularization(y)
+            L = L_feat + L_style + L_tv
+
+            if main:
+                print '(epoch {}) batch {}/{}... training loss is...{}'.format(epoch, i, n_iter, L.data)
+            telemetry.lap('loss')
+
+            L.backward()
+            telemetry.lap('backward')
+            if sync is not None:
+                sync.allreduce()
+                telemetry.lap('allreduce')
+            O.update()
+            if sync is not None:
+                # each rank's BatchNormalization statistics only saw its own batch
+                sync.sync_stats()
+            telemetry.lap('update')
+
+            if writer and writer.due(i):
+                writer.save('{}_{}_{}'.format(output, epoch, i), model, O, periodic=True)
+                telemetry.lap('checkpoint')
+            telemetry.end({'feat': L_feat, 'style': L_style, 'tv': L_tv, 'total': L})
+
+        if main:
+            print 'epoch {} took {:.1f} sec'.format(epoch, time.time() - start)
+            if feature_cache:
+                print 'feature cache: {} hits, {} misses, {:.1f} MB'.format(
+                    feature_cache.hits, feature_cache.misses, feature_cache.total_bytes / 1024.**2)
+            print 'save "style.model"'
+            writer.save('{}_{}'.format(output, epoch), model, O)
+
+    if main:
+        writer.save(output, model, O)
+        writer.close()
+    telemetry.close()
+    loader.close()
+
+if args.workers > 1:
+    model = FastStyleNet(args.width, args.n_residual)
+    launch(train, args.workers, SharedAllreduce(parameter_count(model), args.workers),
+           SharedAllreduce(running_stats_count(model), args.workers))
+else:
+    train()